@@ -0,0 +1,368 @@
+"""Stress the claim path with many concurrent worker processes
+
+Usage: python benchmarks/contention.py [-w 1,8,32] [-j 500] [-t 0.01]
+                                       [-m claim|run] [-u URL] [-l 0.1]
+
+Each simulated worker is a separate process with its own connections, as
+jobs started by the scheduler are. In `claim` mode, workers claim pending
+jobs with claim_jobs, write a heartbeat, save a result and mark the job
+completed until no job is left. In `run` mode, every worker goes through
+main.run for its share of job configurations, which registers the
+experiment and the job before running it, as hundreds of jobs starting at
+once do.
+
+One JSON line is reported per number of workers with the throughput, the
+time spent waiting for locks, lock timeouts, deadlocks, duplicate claims
+and claim latency percentiles. Lock waits are cut short by a lock timeout
+(busy_timeout on SQLite, lock_timeout on Postgres) so that they surface
+here instead of inside the driver: the time of attempts failing on a lock
+and of the back off before retrying them is counted as lock wait. A
+SQLite file is used unless a SQLAlchemy url is given, e.g. to a local
+Postgres.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+import utils
+
+TABLE_NAME = "contention_jobs"
+EXPERIMENT_NAME = "contention"
+
+JOB_MODULE = """import time
+
+
+def jobman_main(state, channel):
+    time.sleep(state["work_time"])
+    state["result"] = state["seed"] * 2
+    # main.run saves the state as is once done
+    state["jobman"]["status"] = 2
+    return channel.COMPLETE
+"""
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q / 100.))]
+
+
+class Stats(object):
+    """What a worker observed, sent back to the harness as a dict"""
+
+    def __init__(self):
+        self.claimed_ids = []
+        self.claim_latencies = []
+        self.lock_wait = 0.
+        self.lock_retries = 0
+        self.lock_timeouts = 0
+        self.deadlocks = 0
+        self.errors = []
+
+    def retry(self, function, *args, **kwargs):
+        """Call function until it does not fail on a lock"""
+        from sqlalchemy.exc import DBAPIError
+
+        while True:
+            start_time = time.time()
+            try:
+                return function(*args, **kwargs)
+            except DBAPIError as e:
+                message = str(e).lower()
+                if "deadlock" in message:
+                    self.deadlocks += 1
+                elif "lock" in message:
+                    self.lock_timeouts += 1
+                else:
+                    raise
+            self.back_off(start_time)
+
+    def back_off(self, start_time):
+        """Let other workers go through before retrying a failed attempt"""
+        time.sleep(random.uniform(0, 0.05))
+        self.lock_retries += 1
+        self.lock_wait += time.time() - start_time
+
+    def retry_chunks(self, function, table_name, rows, *args, **kwargs):
+        """Call Database.update or delete until no chunk fails
+
+        They do not raise when a chunk fails on a lock, the chunk is rolled
+        back and its ids are returned as failed_ids. Only rows of failed
+        chunks are given to the next attempt.
+        """
+        processed = None
+        while True:
+            start_time = time.time()
+            processed_now, failed_ids = self.retry(
+                function, table_name, rows, *args, **kwargs)
+            if processed is None:
+                processed = processed_now
+            else:
+                processed += processed_now
+
+            if len(failed_ids) == 0:
+                return processed, failed_ids
+
+            self.lock_timeouts += 1
+            self.back_off(start_time)
+            rows = [dict(id=row_id) for row_id in failed_ids]
+
+
+def retried(stats, method):
+    """Wrap a Database method so that each call is retried on locks
+
+    Dict arguments are copied for each attempt, save removes the id of the
+    row it is given. Failed chunks of update and delete are retried too.
+    """
+
+    def retried_method(*args, **kwargs):
+        if method.__name__ in ["update", "delete"]:
+            return stats.retry_chunks(method, *args, **kwargs)
+
+        return stats.retry(lambda: method(
+            *[dict(arg) if isinstance(arg, dict) else arg for arg in args],
+            **kwargs))
+
+    return retried_method
+
+
+def use_database(options):
+    """Point the database to the one of options, with a short lock timeout"""
+    from sqlalchemy import event
+    from distributed_jobman.database import database
+
+    if not options.url:
+        utils.use_sqlite(database, "contention.sqlite")
+        database.busy_timeout = options.lock_timeout
+        return database
+
+    utils.use_engine(database, options.url)
+    if database._engine.dialect.name == "postgresql":
+        @event.listens_for(database._engine, "connect")
+        def connect(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("SET lock_timeout = %d" %
+                           int(options.lock_timeout * 1000))
+            cursor.close()
+            # Settings are commited like any other statement
+            dbapi_connection.commit()
+
+    return database
+
+
+def claim_worker(options, queue):
+    from jobman import sql
+    from distributed_jobman.database import database
+    import distributed_jobman.schedulers.jobs as job_scheduler
+
+    use_database(options)
+    stats = Stats()
+
+    try:
+        while True:
+            start_time = time.time()
+            jobs = stats.retry(job_scheduler.claim_jobs, TABLE_NAME, 1)
+            stats.claim_latencies.append(time.time() - start_time)
+
+            if len(jobs) == 0:
+                break
+
+            job = jobs[0]
+            stats.claimed_ids.append(job["id"])
+
+            time.sleep(options.work_time / 2.)
+            stats.retry(database.touch, TABLE_NAME, [job["id"]],
+                        job_scheduler.HEARTBEAT, time.time())
+            time.sleep(options.work_time / 2.)
+
+            job["result"] = job["seed"] * 2
+            job["jobman"]["status"] = sql.DONE
+            # save_job removes the id of the job it is given, each attempt
+            # gets its own copy
+            stats.retry(lambda: job_scheduler.save_job(TABLE_NAME, dict(job)))
+    except Exception as e:
+        stats.errors.append(repr(e))
+
+    queue.put(stats.__dict__)
+
+
+def run_worker(options, queue, job_config_files):
+    from distributed_jobman import main as distributed_jobman_main
+    from distributed_jobman.database import database
+    import distributed_jobman.schedulers.jobs as job_scheduler
+
+    use_database(options)
+    stats = Stats()
+
+    # Claims issued by main.run are timed and recorded
+    claim_jobs = job_scheduler.claim_jobs
+
+    def timed_claim_jobs(*args, **kwargs):
+        start_time = time.time()
+        jobs = claim_jobs(*args, **kwargs)
+        stats.claim_latencies.append(time.time() - start_time)
+        stats.claimed_ids += [job["id"] for job in jobs]
+        return jobs
+
+    job_scheduler.claim_jobs = timed_claim_jobs
+
+    # main.run as a whole cannot be run again once it registered its job,
+    # each of its database calls is retried instead
+    for name in ["load", "save", "save_many", "update", "delete", "claim",
+                 "touch", "count_by_status"]:
+        setattr(database, name, retried(stats, getattr(database, name)))
+
+    sys.stdout = open(os.devnull, "w")
+    for job_config_file in job_config_files:
+        try:
+            distributed_jobman_main.run(
+                "contention_job", utils.get_path("experiment.json"),
+                job_config_file, False)
+        except Exception as e:
+            stats.errors.append(repr(e))
+
+    queue.put(stats.__dict__)
+
+
+def prepare(options, nb_of_workers):
+    """Build the database and return the arguments of each worker"""
+    from distributed_jobman.database import database
+    import distributed_jobman.schedulers.experiments as experiment_scheduler
+    import distributed_jobman.schedulers.jobs as job_scheduler
+
+    if not options.url:
+        for suffix in ["", "-wal", "-shm"]:
+            path = utils.get_path("contention.sqlite" + suffix)
+            if os.path.exists(path):
+                os.remove(path)
+    use_database(options)
+
+    for table_name in [TABLE_NAME, "experiments"]:
+        job_scheduler.delete_all_jobs(table_name)
+
+    if options.mode == "claim":
+        experiment_scheduler.save_experiment(
+            name=EXPERIMENT_NAME, table_name=TABLE_NAME,
+            clusters=dict(local=dict(root="/tmp", max_running=0,
+                                     max_queued=0)),
+            duree="", mem="", env="", gpu="")
+        job_scheduler.save_jobs(
+            TABLE_NAME, (utils.make_job(i) for i in xrange(options.jobs)))
+        database.close()
+        return [() for i in xrange(nb_of_workers)]
+
+    with open(utils.get_path("contention_job.py"), "w") as f:
+        f.write(JOB_MODULE)
+    if utils.get_path("") not in sys.path:
+        sys.path.insert(0, utils.get_path(""))
+
+    with open(utils.get_path("experiment.json"), "w") as f:
+        json.dump(dict(experiment_name=EXPERIMENT_NAME,
+                       clusters=dict(local=dict(root="/tmp", max_running=0,
+                                                max_queued=0))), f)
+
+    job_config_files = []
+    for i in xrange(options.jobs):
+        directory = utils.get_path(os.path.join("jobs", str(i)))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        job_config_file = os.path.join(directory, "job.json")
+        job = utils.make_job(i)
+        job["work_time"] = options.work_time
+        with open(job_config_file, "w") as f:
+            json.dump(job, f)
+        job_config_files.append(job_config_file)
+
+    database.close()
+
+    return [(job_config_files[index::nb_of_workers], )
+            for index in xrange(nb_of_workers)]
+
+
+def count_completed(options):
+    from distributed_jobman.database import database
+    import distributed_jobman.schedulers.jobs as job_scheduler
+
+    use_database(options)
+    count = job_scheduler.count_jobs(TABLE_NAME)["completed"][0]
+    database.close()
+
+    return count
+
+
+def stress(options, nb_of_workers):
+    worker_arguments = prepare(options, nb_of_workers)
+    target = claim_worker if options.mode == "claim" else run_worker
+
+    queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=target,
+                                         args=(options, queue) + arguments)
+                 for arguments in worker_arguments]
+
+    start_time = time.time()
+    for process in processes:
+        process.start()
+    # Results must be read before joining, a full queue blocks its writer
+    results = [queue.get() for process in processes]
+    for process in processes:
+        process.join()
+    wall_time = time.time() - start_time
+
+    claimed_ids = sum((result["claimed_ids"] for result in results), [])
+    latencies = sum((result["claim_latencies"] for result in results), [])
+    errors = sum((result["errors"] for result in results), [])
+    nb_of_completed_jobs = count_completed(options)
+
+    utils.report(
+        "contention", mode=options.mode, workers=nb_of_workers,
+        jobs=options.jobs, work_time=options.work_time,
+        wall_time=wall_time,
+        completed_jobs=nb_of_completed_jobs,
+        throughput=nb_of_completed_jobs / wall_time,
+        lock_wait=sum(result["lock_wait"] for result in results),
+        lock_retries=sum(result["lock_retries"] for result in results),
+        lock_timeouts=sum(result["lock_timeouts"] for result in results),
+        deadlocks=sum(result["deadlocks"] for result in results),
+        errors=len(errors),
+        error_samples=sorted(set(errors))[:5],
+        duplicate_claims=len(claimed_ids) - len(set(claimed_ids)),
+        claim_p50=percentile(latencies, 50),
+        claim_p99=percentile(latencies, 99),
+        claim_max=max(latencies) if latencies else None)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--workers", default="1,8,32", help="""
+        Comma separated numbers of concurrent workers to try""")
+    parser.add_argument("-j", "--jobs", type=int, default=500, help="""
+        Number of jobs run for each number of workers""")
+    parser.add_argument("-t", "--work-time", type=float, default=0.01,
+                        help="""
+        Seconds each job works""")
+    parser.add_argument("-m", "--mode", choices=["claim", "run"],
+                        default="claim")
+    parser.add_argument("-u", "--url", default=None, help="""
+        SQLAlchemy url of the database, a SQLite file by default""")
+    parser.add_argument("-l", "--lock-timeout", type=float, default=0.1,
+                        help="""
+        Seconds a statement waits for a lock before failing and being
+        retried""")
+    options = parser.parse_args(argv)
+
+    utils.setup()
+
+    for nb_of_workers in [int(n) for n in options.workers.split(",")]:
+        stress(options, nb_of_workers)
+
+    utils.teardown()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,53 @@
+"""Compare queries issued to load rows with and without lazy loading
+
+Usage: python benchmarks/eager_load.py [nb_of_rows ...]
+
+The lazy mode reproduces how rows used to be expanded, one lazy load of
+key/value pairs per row. The pivot mode is Database.load.
+"""
+import sys
+import time
+
+import utils
+
+
+def lazy_load(database, table_name):
+    from jobman.tools import expand
+
+    db = database._open_db(table_name)
+    session = db.session()
+    rows = [expand(dict(sql_row.iteritems()))
+            for sql_row in db.query(session).all()]
+    session.close()
+    return rows
+
+
+def pivot_load(database, table_name):
+    return database.load(table_name)
+
+
+def main(argv):
+    utils.setup()
+    sizes = [int(size) for size in argv] or [100, 1000, 10000]
+
+    database = utils.open_database()
+    counter = utils.QueryCounter(database._get_engine())
+
+    for size in sizes:
+        table_name = "eager_load_%d" % size
+        database.save_many(table_name,
+                           (utils.make_job(i) for i in xrange(size)))
+
+        for mode, load in [("lazy", lazy_load), ("pivot", pivot_load)]:
+            counter.reset()
+            start = time.time()
+            rows = load(database, table_name)
+            utils.report("eager_load", mode=mode, rows=len(rows),
+                         queries=counter.count,
+                         wall_time=time.time() - start)
+
+    utils.teardown()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,98 @@
+"""Time a full launch cycle against a stubbed scheduler
+
+Usage: python benchmarks/launch_cycle.py [nb_of_jobs ...]
+
+Pending jobs (1k, 10k and 100k by default) are spread over
+NB_OF_EXPERIMENTS experiments stored in a SQLite file. qstat and
+jobdispatch are replaced by scripts reporting an empty queue and accepting
+every submission, so the cycle covers the database, the process layer and
+the planning logic of main.launch without any scheduler. Submissions are
+not rate limited.
+"""
+import os
+import sys
+
+import utils
+
+NB_OF_EXPERIMENTS = 10
+
+CLUSTER = "benchmark"
+
+STUBS = dict(
+    qstat="#!/bin/sh\necho '<Data></Data>'\n",
+    jobdispatch="#!/bin/sh\nexit 0\n")
+
+
+def install_stubs():
+    """Put stubbed scheduler commands first in PATH"""
+    directory = utils.get_path("bin")
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    for name, content in STUBS.iteritems():
+        path = os.path.join(directory, name)
+        with open(path, "w") as f:
+            f.write(content)
+        os.chmod(path, 0755)
+
+    os.environ["PATH"] = directory + os.pathsep + os.environ["PATH"]
+
+
+def build_experiments(size):
+    from distributed_jobman.database import database
+    import distributed_jobman.schedulers.experiments as experiment_scheduler
+    import distributed_jobman.schedulers.jobs as job_scheduler
+
+    utils.use_sqlite(database, "launch_cycle_%d.sqlite" % size)
+
+    for index in xrange(NB_OF_EXPERIMENTS):
+        name = "benchmark_%d" % index
+        experiment_scheduler.save_experiment(
+            name=name, table_name=name + "_jobs",
+            clusters={CLUSTER: dict(root="/tmp", max_running=size,
+                                    max_queued=0)},
+            duree="1:00:00", mem="1G", env="", gpu="")
+        job_scheduler.save_jobs(
+            name + "_jobs",
+            (utils.make_job(i)
+             for i in xrange(index, size, NB_OF_EXPERIMENTS)))
+
+
+def main(argv):
+    utils.setup()
+    sizes = [int(size) for size in argv] or [1000, 10000, 100000]
+
+    install_stubs()
+
+    from distributed_jobman import config
+    from distributed_jobman.database import database
+    from distributed_jobman import main as distributed_jobman_main
+
+    config["launch"]["rate"] = 0
+
+    counter = utils.QueryCounter()
+
+    for size in sizes:
+        build_experiments(size)
+        # Experiments and scheduler are not cached from the build
+        database.cache.invalidate()
+
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            with utils.Measure(counter) as measure:
+                distributed_jobman_main.launch(CLUSTER, 0, None)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+        utils.report("launch_cycle", size=size,
+                     experiments=NB_OF_EXPERIMENTS, **measure.values)
+
+        database.close()
+
+    utils.teardown()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
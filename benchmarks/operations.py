@@ -0,0 +1,116 @@
+"""Time the job operations of schedulers.jobs on synthetic tables
+
+Usage: python benchmarks/operations.py [nb_of_jobs ...]
+
+For each size (1k, 10k and 100k jobs by default), a table of jobs with
+mixed statuses is built once in a SQLite file. Each operation then runs on
+a fresh copy of it and reports its wall time, number of SQL queries and
+peak RSS as one JSON object per line, e.g. to be compared across commits.
+"""
+import shutil
+import sys
+
+import utils
+
+TABLE_NAME = "benchmark_jobs"
+
+# Share of jobs of each non pending status, in %
+STATUS_SHARES = [("running", 10), ("completed", 20), ("broken", 5)]
+
+NB_OF_SAVED_JOBS = 100
+
+
+def build_table(size):
+    """Build the reference table of given size, return its file name"""
+    from jobman import sql
+    from distributed_jobman.database import database
+    import distributed_jobman.schedulers.jobs as job_scheduler
+
+    file_name = "operations_%d.sqlite" % size
+    utils.use_sqlite(database, file_name)
+
+    counter = utils.QueryCounter()
+    with utils.Measure(counter) as measure:
+        ids = job_scheduler.save_jobs(
+            TABLE_NAME, (utils.make_job(i) for i in xrange(size)))
+    utils.report("save_jobs", size=size, **measure.values)
+
+    statuses = dict(running=sql.RUNNING, completed=sql.DONE,
+                    broken=sql.ERR_RUN)
+    start = 0
+    for name, share in STATUS_SHARES:
+        end = start + size * share // 100
+        job_scheduler.update_jobs(
+            TABLE_NAME, [dict(id=job_id) for job_id in ids[start:end]],
+            {sql.STATUS: statuses[name]})
+        start = end
+
+    database.close()
+
+    return file_name
+
+
+def get_operations(size):
+    from jobman import sql
+    import distributed_jobman.schedulers.jobs as job_scheduler
+
+    def load_filtered():
+        return job_scheduler.load_jobs(
+            TABLE_NAME, {sql.STATUS: sql.START, "params.layers.nb": 2},
+            cache=False)
+
+    def save_one_by_one():
+        for i in xrange(NB_OF_SAVED_JOBS):
+            job_scheduler.save_job(TABLE_NAME, utils.make_job(size + i))
+
+    # (name, operation, number of calls timed together)
+    return [
+        ("load_jobs", lambda: job_scheduler.load_jobs(TABLE_NAME,
+                                                      cache=False), 1),
+        ("load_pending_jobs",
+         lambda: job_scheduler.load_jobs(TABLE_NAME, {sql.STATUS: sql.START},
+                                         cache=False), 1),
+        ("load_filtered_jobs", load_filtered, 1),
+        ("count_jobs", lambda: job_scheduler.count_jobs(TABLE_NAME,
+                                                        sample_size=20), 1),
+        ("update_jobs",
+         lambda: job_scheduler.set_jobs(TABLE_NAME, "completed",
+                                        {"proc_status": "archived"}), 1),
+        ("delete_jobs",
+         lambda: job_scheduler.delete_jobs(
+             TABLE_NAME, None,
+             filter_eq_dct={sql.STATUS: job_scheduler.STATUSES["broken"]}),
+         1),
+        ("save_job", save_one_by_one, NB_OF_SAVED_JOBS)]
+
+
+def main(argv):
+    utils.setup()
+    sizes = [int(size) for size in argv] or [1000, 10000, 100000]
+
+    from distributed_jobman.database import database
+
+    counter = utils.QueryCounter()
+
+    for size in sizes:
+        reference_file_name = build_table(size)
+
+        for name, operation, nb_of_calls in get_operations(size):
+            shutil.copy(utils.get_path(reference_file_name),
+                        utils.get_path("operations.sqlite"))
+            utils.use_sqlite(database, "operations.sqlite")
+            # Tables are opened outside of the measure
+            database._open_db(TABLE_NAME)
+
+            with utils.Measure(counter) as measure:
+                operation()
+            utils.report(name, size=size, calls=nb_of_calls,
+                         **measure.values)
+
+        database.close()
+
+    utils.teardown()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,186 @@
+"""Helpers to run benchmarks against a throw-away SQLite database
+
+distributed_jobman reads ~/.distributed_jobman.rc when imported, hence
+setup() must be called before importing anything from it.
+"""
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+RC_TEMPLATE = """[database]
+backend = sqlite
+
+[scheduler]
+type = cluster
+"""
+
+_directory = None
+
+
+def setup():
+    """Point HOME to a temporary directory holding a configuration file"""
+    global _directory
+
+    if _directory is None:
+        _directory = tempfile.mkdtemp(prefix="distributed_jobman_benchmark_")
+        with open(os.path.join(_directory, ".distributed_jobman.rc"), 'w') as f:
+            f.write(RC_TEMPLATE)
+        os.environ["HOME"] = _directory
+        sys.path.insert(
+            0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    return _directory
+
+
+def teardown():
+    global _directory
+
+    if _directory is not None:
+        shutil.rmtree(_directory, ignore_errors=True)
+        _directory = None
+
+
+def get_path(file_name):
+    """Path of a file in the temporary directory"""
+    return os.path.join(setup(), file_name)
+
+
+def use_sqlite(database, file_name):
+    """Point an existing Database, e.g. the module's singleton, to a file
+
+    Tables are reopened and cached rows are dropped, the file is kept if it
+    exists.
+    """
+    database.close()
+    database.cache.invalidate()
+    database.backend = "sqlite"
+    database.path = get_path(file_name)
+
+    return database
+
+
+def use_engine(database, url):
+    """Point an existing Database to the database of a SQLAlchemy url"""
+    from sqlalchemy import create_engine
+
+    database.close()
+    database.cache.invalidate()
+    database._engine = create_engine(url)
+
+    return database
+
+
+def open_database(file_name="benchmark.sqlite"):
+    """Return a Database stored in a SQLite file of the temporary directory"""
+    from distributed_jobman.database import Database
+
+    path = get_path(file_name)
+    if os.path.exists(path):
+        os.remove(path)
+
+    return Database(backend="sqlite", path=path)
+
+
+class QueryCounter(object):
+    """Count SQL statements executed by an engine, or by all if None"""
+
+    def __init__(self, engine=None):
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        self.count = 0
+        event.listen(engine if engine is not None else Engine,
+                     "before_cursor_execute", self._increment)
+
+    def _increment(self, *args, **kwargs):
+        self.count += 1
+
+    def reset(self):
+        self.count = 0
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of the process, Linux only
+
+    Returns False if it could not be reset, peak_rss() then gives the peak
+    since the start of the process.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except IOError:
+        return False
+
+
+def peak_rss():
+    """Peak resident set size of the process in KB"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Measure(object):
+    """Measure wall time, SQL queries and peak RSS of a with block
+
+    Values are available in `values` once the block is done.
+    """
+
+    def __init__(self, counter):
+        self.counter = counter
+        self.values = None
+
+    def __enter__(self):
+        self.counter.reset()
+        reset_peak_rss()
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exception_type, exception_val, traceback):
+        self.values = dict(wall_time=time.time() - self.start_time,
+                           queries=self.counter.count,
+                           peak_rss_kb=peak_rss())
+
+
+def get_commit():
+    """Commit of the working tree benchmarked, None outside of git"""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_job(i):
+    """Job description shaped like a typical hyper-parameter sweep point"""
+    return dict(
+        params=dict(learning_rate=dict(values=10 ** -(1 + i % 5)),
+                    momentum=0.5 + (i % 10) / 20.,
+                    layers=dict(nb=1 + i % 4, size=128 * (1 + i % 8))),
+        dataset="mnist",
+        seed=i)
+
+
+_commit = get_commit()
+
+
+def report(name, **values):
+    """Print a result as one JSON object per line, tagged with the commit"""
+    values["name"] = name
+    values["time"] = time.time()
+    values["commit"] = _commit
+    sys.stdout.write(json.dumps(values, sort_keys=True) + "\n")
+    sys.stdout.flush()
@@ -3,8 +3,9 @@ from parsers.config import config
 from database import Database, get_db_string
 
 from schedulers.experiments import save_experiment, load_experiments
-from schedulers.jobs import save_job, load_jobs, submit_job
+from schedulers.jobs import (
+    save_job, save_jobs, load_jobs, iter_jobs, submit_job)
 
 
-__all__ = [config, save_experiment, load_experiments, save_job, load_jobs,
-           submit_job, get_db_string]
+__all__ = [config, save_experiment, load_experiments, save_job, save_jobs,
+           load_jobs, iter_jobs, submit_job, get_db_string]
@@ -1,26 +1,420 @@
+import contextlib
+import functools
+import itertools
+import json
 import logging
 import sys
+import threading
 
-from psycopg2 import OperationalError 
+try:
+    from psycopg2 import OperationalError
+except ImportError:
+    # psycopg2 is only needed by the postgres backend
+    from sqlite3 import OperationalError
 
 from jobman import sql
-from jobman.api0 import open_db
+from jobman.api0 import db_from_engine
 from jobman.tools import flatten, expand
+from sqlalchemy import (
+    BigInteger, Column, Float, Index, Integer, Table, and_, create_engine,
+    event, exists, func, inspect, literal, literal_column, null, or_,
+    select)
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import class_mapper
 
-from distributed_jobman import config
-from distributed_jobman.utils import Cache, SafeSession
+from distributed_jobman import config, metrics
+from distributed_jobman.utils import Cache, SafeSession, SessionInterrupted
 
 
 logger = logging.getLogger("database")
 
-cache = Cache(timeout=config["database"]["cache_timeout"])
+ENGINE_STRING_TEMPLATE = "postgres://%(username)s:%(password)s@%(database_address)s/%(database_name)s"
+DB_STRING_TEMPLATE = ENGINE_STRING_TEMPLATE + "?table=%(table_name)s"
 
-DB_STRING_TEMPLATE = "postgres://%(username)s:%(password)s@%(database_address)s/%(database_name)s?table=%(table_name)s"
+SQLITE_ENGINE_STRING_TEMPLATE = "sqlite:///%(path)s"
+SQLITE_DB_STRING_TEMPLATE = SQLITE_ENGINE_STRING_TEMPLATE + "?table=%(table_name)s"
+
+CHUNK_SIZE = 1000
+
+VALUE_COLUMNS = ["type", "ival", "fval", "sval", "bval"]
+
+# Keys which jobman mirrors in columns of the dict table
+MIRRORED_COLUMNS = {sql.STATUS: "status", sql.PRIORITY: "priority",
+                    sql.HASH: "hash"}
+
+
+def _tables(db):
+    return (class_mapper(db._Dict).mapped_table,
+            class_mapper(db._KeyVal).mapped_table)
+
+
+def _define_status_table(db, table_name):
+    """Narrow copy of the status, hash and priority of each row
+
+    Kept in sync with the key/value pairs by triggers of the database, see
+    _status_triggers, it serves status lookups, counts and claims from
+    indexes. updated_at is the time of the last change of status, or of
+    the last save or update through Database, heartbeats written by touch
+    leave it as is. Deleted rows are kept with a NULL status until the
+    table is rebuilt.
+    """
+    dict_table, pair_table = _tables(db)
+    name = "%sstatus" % table_name
+    if name in dict_table.metadata.tables:
+        return dict_table.metadata.tables[name]
+
+    status_table = Table(
+        name, dict_table.metadata,
+        Column("id", Integer, primary_key=True, autoincrement=False),
+        Column("status", Integer),
+        Column("hash", BigInteger),
+        Column("priority", Float),
+        Column("updated_at", Float),
+        Index("%s_hash_idx" % name, "hash"),
+        Index("%s_updated_at_idx" % name, "updated_at"))
+
+    # Pending rows are claimed by decreasing priority, then by id
+    Index("%s_status_priority_idx" % name, status_table.c.status,
+          status_table.c.priority.desc(), status_table.c.id)
+
+    return status_table
+
+
+# Current time in seconds since the epoch, as computed by the database
+NOW_SQL = {
+    "sqlite": "((julianday('now') - 2440587.5) * 86400.0)",
+    "postgresql": "extract(epoch from clock_timestamp())"}
+
+SQLITE_STATUS_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS %(dict)s_status_insert
+    AFTER INSERT ON %(dict)s
+    BEGIN
+        INSERT OR REPLACE INTO %(status)s (id, hash, updated_at)
+        VALUES (NEW.id, NEW.hash, %(now)s);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS %(dict)s_status_update
+    AFTER UPDATE ON %(dict)s WHEN NEW.hash IS NOT OLD.hash
+    BEGIN
+        UPDATE %(status)s SET hash = NEW.hash WHERE id = NEW.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS %(pair)s_status_insert
+    AFTER INSERT ON %(pair)s WHEN NEW.name = '%(status_key)s'
+    BEGIN
+        INSERT OR IGNORE INTO %(status)s (id) VALUES (NEW.dict_id);
+        UPDATE %(status)s SET status = NEW.ival, updated_at = %(now)s
+        WHERE id = NEW.dict_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS %(pair)s_status_update
+    AFTER UPDATE ON %(pair)s
+    WHEN NEW.name = '%(status_key)s' AND NEW.ival IS NOT OLD.ival
+    BEGIN
+        UPDATE %(status)s SET status = NEW.ival, updated_at = %(now)s
+        WHERE id = NEW.dict_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS %(pair)s_status_delete
+    AFTER DELETE ON %(pair)s WHEN OLD.name = '%(status_key)s'
+    BEGIN
+        UPDATE %(status)s SET status = NULL, updated_at = %(now)s
+        WHERE id = OLD.dict_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS %(pair)s_priority_insert
+    AFTER INSERT ON %(pair)s WHEN NEW.name = '%(priority_key)s'
+    BEGIN
+        INSERT OR IGNORE INTO %(status)s (id) VALUES (NEW.dict_id);
+        UPDATE %(status)s SET priority = NEW.fval WHERE id = NEW.dict_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS %(pair)s_priority_update
+    AFTER UPDATE ON %(pair)s
+    WHEN NEW.name = '%(priority_key)s' AND NEW.fval IS NOT OLD.fval
+    BEGIN
+        UPDATE %(status)s SET priority = NEW.fval WHERE id = NEW.dict_id;
+    END"""]
+
+# Concurrent transactions may insert the same status row, hence upserts
+POSTGRES_STATUS_TRIGGERS = [
+    """CREATE OR REPLACE FUNCTION %(dict_function)s() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO %(status)s (id, hash, updated_at)
+            VALUES (NEW.id, NEW.hash, %(now)s)
+            ON CONFLICT (id) DO UPDATE SET
+                status = NULL, hash = EXCLUDED.hash, priority = NULL,
+                updated_at = EXCLUDED.updated_at;
+        ELSIF NEW.hash IS DISTINCT FROM OLD.hash THEN
+            UPDATE %(status)s SET hash = NEW.hash WHERE id = NEW.id;
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION %(pair_function)s() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            IF OLD.name = '%(status_key)s' THEN
+                UPDATE %(status)s SET status = NULL, updated_at = %(now)s
+                WHERE id = OLD.dict_id;
+            END IF;
+            RETURN NULL;
+        END IF;
+
+        IF NEW.name = '%(status_key)s' THEN
+            IF TG_OP = 'UPDATE' THEN
+                IF NEW.ival IS NOT DISTINCT FROM OLD.ival THEN
+                    RETURN NULL;
+                END IF;
+            END IF;
+            INSERT INTO %(status)s (id, status, updated_at)
+            VALUES (NEW.dict_id, NEW.ival, %(now)s)
+            ON CONFLICT (id) DO UPDATE SET
+                status = EXCLUDED.status, updated_at = EXCLUDED.updated_at;
+        ELSIF NEW.name = '%(priority_key)s' THEN
+            INSERT INTO %(status)s (id, priority)
+            VALUES (NEW.dict_id, NEW.fval)
+            ON CONFLICT (id) DO UPDATE SET priority = EXCLUDED.priority;
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql""",
+    "DROP TRIGGER IF EXISTS %(dict_trigger)s ON %(dict)s",
+    """CREATE TRIGGER %(dict_trigger)s AFTER INSERT OR UPDATE ON %(dict)s
+    FOR EACH ROW EXECUTE PROCEDURE %(dict_function)s()""",
+    "DROP TRIGGER IF EXISTS %(pair_trigger)s ON %(pair)s",
+    """CREATE TRIGGER %(pair_trigger)s
+    AFTER INSERT OR UPDATE OR DELETE ON %(pair)s
+    FOR EACH ROW EXECUTE PROCEDURE %(pair_function)s()"""]
+
+
+def _status_triggers(db, dialect):
+    """Statements creating the triggers which fill the status table
+
+    Triggers run in the transaction of any writer of the key/value pairs,
+    including jobman itself, e.g. `jobman sql` moving jobs to running and
+    completed.
+    """
+    dict_table, pair_table = _tables(db)
+    preparer = dialect.identifier_preparer
+    names = dict(
+        dict=preparer.format_table(dict_table),
+        pair=preparer.format_table(pair_table),
+        status=preparer.format_table(db.status_table),
+        dict_function=preparer.quote("%s_status_sync" % dict_table.name),
+        pair_function=preparer.quote("%s_status_sync" % pair_table.name),
+        dict_trigger=_status_trigger_name(dict_table),
+        pair_trigger=_status_trigger_name(pair_table),
+        now=NOW_SQL[dialect.name],
+        status_key=sql.STATUS,
+        priority_key=sql.PRIORITY)
+
+    if dialect.name == "postgresql":
+        templates = POSTGRES_STATUS_TRIGGERS
+    else:
+        templates = SQLITE_STATUS_TRIGGERS
+
+    return [template % names for template in templates]
+
+
+def _status_trigger_name(table):
+    return "%s_status_trigger" % table.name
+
+
+def _sqlite_status_trigger_names(db):
+    """Names of the triggers of SQLITE_STATUS_TRIGGERS"""
+    dict_table, pair_table = _tables(db)
+    return (["%s_status_%s" % (dict_table.name, event)
+             for event in ["insert", "update"]] +
+            ["%s_status_%s" % (pair_table.name, event)
+             for event in ["insert", "update", "delete"]] +
+            ["%s_priority_%s" % (pair_table.name, event)
+             for event in ["insert", "update"]])
+
+
+def _select_status_rows(db, dialect):
+    """Select the status rows of all rows from their key/value pairs"""
+    dict_table, pair_table = _tables(db)
+
+    def pair_value(key, column):
+        return (select([pair_table.c[column]])
+                .where(and_(pair_table.c.dict_id == dict_table.c.id,
+                            pair_table.c.name == key))
+                .limit(1).as_scalar())
+
+    return select([dict_table.c.id,
+                   pair_value(sql.STATUS, "ival"),
+                   dict_table.c.hash,
+                   pair_value(sql.PRIORITY, "fval"),
+                   literal_column(NOW_SQL[dialect.name], type_=Float)])
+
+
+def _mark_updated(db, session, ids):
+    """Advance updated_at of given row ids to the current time"""
+    session.execute(
+        db.status_table.update()
+        .where(db.status_table.c.id.in_(ids))
+        .values(updated_at=literal_column(NOW_SQL[session.bind.dialect.name],
+                                          type_=Float)))
+
+
+def _refresh_status(db, session, ids):
+    """Set the status of given row ids back to the one of their pairs"""
+    dict_table, pair_table = _tables(db)
+    status_table = db.status_table
+
+    session.execute(
+        status_table.update()
+        .where(status_table.c.id.in_(ids))
+        .values(status=select([pair_table.c.ival])
+                .where(and_(pair_table.c.dict_id == status_table.c.id,
+                            pair_table.c.name == sql.STATUS))
+                .limit(1).as_scalar()))
+
+
+def _value_column(db, value):
+    if isinstance(value, basestring):
+        return db._KeyVal.sval
+    elif isinstance(value, float):
+        return db._KeyVal.fval
+    elif isinstance(value, (int, long)):
+        return db._KeyVal.ival
+
+    raise TypeError("Cannot filter on value %s" % repr(value))
+
+
+def _filter_clauses(db, filter_eq_dct):
+    """Build clauses selecting rows whose keys are equal to given values
+
+    Same as jobman's filter_eq_dct except that a list or a tuple of values
+    matches rows equal to any of them.
+    """
+    clauses = []
+    for key, value in (filter_eq_dct or {}).iteritems():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        # Served by the status table index
+        if key == sql.STATUS:
+            clauses.append(db._Dict.id.in_(
+                select([db.status_table.c.id])
+                .where(db.status_table.c.status.in_(values))))
+            continue
+
+        clauses.append(db._Dict._attrs.any(
+            and_(db._KeyVal.name == key,
+                 _value_column(db, values[0]).in_(values))))
+
+    return clauses
+
+
+def _fields_clause(db, fields):
+    """Build a clause selecting the flattened keys of given fields
+
+    A field selects the key of the same name and all keys nested under it,
+    `jobman` selecting for example `jobman.status` and `jobman.sql.priority`.
+    """
+    clauses = []
+    for field in fields:
+        prefix = (field.replace("\\", "\\\\").replace("%", "\\%")
+                  .replace("_", "\\_"))
+        clauses.append(db._KeyVal.name == field)
+        clauses.append(db._KeyVal.name.like(prefix + ".%", escape="\\"))
+
+    return or_(*clauses)
+
+
+def _invalidates_cache(method):
+    """Invalidate cached rows of the table written by method"""
+
+    @functools.wraps(method)
+    def write(self, table_name, *args, **kwargs):
+        try:
+            return method(self, table_name, *args, **kwargs)
+        finally:
+            self.cache.invalidate(table_name)
+
+    return write
+
+
+# Set by _write_transactions, per thread
+_immediate = threading.local()
+
+
+@contextlib.contextmanager
+def _write_transactions():
+    """Begin SQLite transactions of the with block with BEGIN IMMEDIATE"""
+    enabled = getattr(_immediate, "enabled", False)
+    _immediate.enabled = True
+    try:
+        yield
+    finally:
+        _immediate.enabled = enabled
+
+
+def _configure_sqlite(engine, busy_timeout):
+    """Set up a SQLite engine for concurrent local processes
+
+    The WAL journal lets readers go on while a transaction writes. Write
+    transactions, begun within _write_transactions(), take the write lock
+    when they begin (BEGIN IMMEDIATE), so that they never fail on a lock
+    they would need to upgrade, concurrent writers wait up to busy_timeout
+    seconds for each other instead. Other transactions only read and never
+    wait.
+    """
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        # Transactions are begun by the begin event instead of pysqlite
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout=%d" % int(busy_timeout * 1000))
+        cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def begin(connection):
+        if getattr(_immediate, "enabled", False):
+            connection.execute("BEGIN IMMEDIATE")
+        else:
+            connection.execute("BEGIN")
+
+    return engine
+
+
+def _timed(method):
+    """Observe the duration of method, labelled by table and command"""
+
+    @functools.wraps(method)
+    def timed(self, table_name, *args, **kwargs):
+        with metrics.time_block("database_seconds", table=table_name,
+                                command=method.__name__):
+            return method(self, table_name, *args, **kwargs)
+
+    return timed
+
+
+def _iter_batches(iterable, batch_size):
+    iterator = iter(iterable)
+    batch = list(itertools.islice(iterator, batch_size))
+    while len(batch) > 0:
+        yield batch
+        batch = list(itertools.islice(iterator, batch_size))
+
+
+def _encode_value(db, key, value):
+    # Let jobman pick the columns used to store the value
+    key_value = db._KeyVal(key, value)
+    return dict((column, getattr(key_value, column, None))
+                for column in VALUE_COLUMNS)
 
 
 class Database(object):
 
-    def __init__(self, username=None, password=None, address=None, name=None):
+    def __init__(self, username=None, password=None, address=None, name=None,
+                 pool_size=None, max_overflow=None, pool_recycle=None,
+                 pool_timeout=None, single_connection=None,
+                 cache_timeout=None, cache_bytes=None, backend=None,
+                 path=None, busy_timeout=None):
+        """Rows of tables stored in postgres, or in a SQLite file
+
+        The backend, `postgres` or `sqlite`, and all other options default
+        to the database section of ~/.distributed_jobman.rc. Credentials
+        and pool options are only used by postgres, path and busy_timeout
+        by sqlite.
+        """
 
         if username is None:
             username = config["database"]["username"]
@@ -30,14 +424,66 @@ class Database(object):
             address = config["database"]["address"]
         if name is None:
             name = config["database"]["name"]
+        if pool_size is None:
+            pool_size = config["database"]["pool_size"]
+        if max_overflow is None:
+            max_overflow = config["database"]["max_overflow"]
+        if pool_recycle is None:
+            pool_recycle = config["database"]["pool_recycle"]
+        if pool_timeout is None:
+            pool_timeout = config["database"]["pool_timeout"]
+        if single_connection is None:
+            single_connection = config["database"]["single_connection"]
+        if cache_timeout is None:
+            cache_timeout = config["database"]["cache_timeout"]
+        if cache_bytes is None:
+            cache_bytes = config["database"]["cache_bytes"]
+        if backend is None:
+            backend = config["database"]["backend"]
+        if path is None:
+            path = config["database"]["path"]
+        if busy_timeout is None:
+            busy_timeout = config["database"]["busy_timeout"]
 
         self.username = username
         self.password = password
         self.address = address
         self.name = name
 
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_recycle = pool_recycle
+        self.pool_timeout = pool_timeout
+        self.single_connection = single_connection
+
+        self.backend = backend
+        self.path = path
+        self.busy_timeout = busy_timeout
+
+        self.cache = Cache(timeout=cache_timeout, max_bytes=cache_bytes)
+
+        self._engine = None
         self._dbs = {}
-        self._cache_rows = {}
+
+    def _get_engine(self):
+        """Engine shared by the handles of all tables of the database"""
+
+        if self._engine is None and self.backend == "sqlite":
+            logger.debug("Create sqlite database engine...")
+            self._engine = _configure_sqlite(
+                create_engine(self.get_engine_string()), self.busy_timeout)
+        elif self._engine is None:
+            logger.debug("Create database engine...")
+            if self.single_connection:
+                pool_options = dict(pool_size=1, max_overflow=0)
+            else:
+                pool_options = dict(pool_size=self.pool_size,
+                                    max_overflow=self.max_overflow)
+            self._engine = create_engine(
+                self.get_engine_string(), pool_recycle=self.pool_recycle,
+                pool_timeout=self.pool_timeout, **pool_options)
+
+        return self._engine
 
     def _open_db(self, table_name):
 
@@ -45,15 +491,163 @@ class Database(object):
 
         if db is None:
             logger.debug("Open database's table %s..." % table_name)
-            db = self._dbs[table_name] = open_db(
-                self.get_db_string(table_name))
+            self._validate_table_name(table_name)
+            db = db_from_engine(self._get_engine(), table_prefix=table_name)
+            # Label of session metrics
+            db.table_name = table_name
+            self._create_indexes(db)
+            self._create_status_table(db, table_name)
+            self._dbs[table_name] = db
 
         return db
 
-    def get_db_string(self, table_name):
+    def _create_status_table(self, db, table_name):
+        """Create the status table and its triggers if needed
+
+        A new status table is filled from existing rows once its triggers
+        are in place.
+        """
+        engine = self._get_engine()
+        db.status_table = _define_status_table(db, table_name)
+
+        created = False
+        if not engine.has_table(db.status_table.name):
+            logger.debug("Create table %s..." % db.status_table.name)
+            try:
+                db.status_table.create(engine)
+                created = True
+            except DBAPIError as e:
+                # Another process may have created it in the meantime
+                logger.warning("Could not create table %s: %s" %
+                               (db.status_table.name, str(e)))
+
+        else:
+            self._create_status_indexes(db)
+
+        self._create_status_triggers(db)
+
+        if created:
+            self._rebuild_status(db)
+
+    def _create_status_indexes(self, db):
+        """Create indexes missing from a status table created earlier
+
+        The (status, id) index of previous versions is replaced by the
+        (status, priority, id) one.
+        """
+        engine = self._get_engine()
+        existing_names = [
+            existing_index["name"] for existing_index
+            in inspect(engine).get_indexes(db.status_table.name)]
+
+        for index in db.status_table.indexes:
+            if index.name in existing_names:
+                continue
+
+            logger.debug("Create index %s..." % index.name)
+            try:
+                index.create(engine)
+            except DBAPIError as e:
+                # Another process may have created it in the meantime
+                logger.warning("Could not create index %s: %s" %
+                               (index.name, str(e)))
+
+        old_name = "%s_status_id_idx" % db.status_table.name
+        if old_name in existing_names:
+            logger.debug("Drop index %s..." % old_name)
+            engine.execute("DROP INDEX IF EXISTS %s" %
+                           engine.dialect.identifier_preparer.quote(old_name))
+
+    def _create_status_triggers(self, db):
+        engine = self._get_engine()
+        dict_table, pair_table = _tables(db)
+
+        if engine.dialect.name == "postgresql":
+            nb_of_triggers = engine.execute(
+                "SELECT count(*) FROM pg_trigger WHERE tgname IN (%s, %s)",
+                _status_trigger_name(dict_table),
+                _status_trigger_name(pair_table)).scalar()
+            if nb_of_triggers == 2:
+                return
+        else:
+            # Creating them takes the write lock, which many processes
+            # opening the table at once would wait for
+            names = _sqlite_status_trigger_names(db)
+            nb_of_triggers = engine.execute(
+                "SELECT count(*) FROM sqlite_master WHERE type = 'trigger' "
+                "AND name IN (%s)" % ", ".join("?" for name in names),
+                *names).scalar()
+            if nb_of_triggers == len(names):
+                return
+
+        logger.debug("Create triggers of table %s..." % db.status_table.name)
+        try:
+            with _write_transactions(), engine.begin() as connection:
+                for statement in _status_triggers(db, engine.dialect):
+                    connection.execute(statement)
+        except DBAPIError as e:
+            # Another process may be creating them in the meantime
+            logger.warning("Could not create triggers of table %s: %s" %
+                           (db.status_table.name, str(e)))
+
+    def _create_indexes(self, db):
+        """Create indexes missing from jobman's schema
+
+        (name, fval) serves range queries on float values such as the
+        heartbeat lookups of stale_ids.
+        """
+        dict_table, pair_table = _tables(db)
+        engine = self._get_engine()
+
+        index = Index("%s_name_fval_idx" % pair_table.name,
+                      pair_table.c.name, pair_table.c.fval)
+
+        existing_names = [existing_index["name"] for existing_index
+                          in inspect(engine).get_indexes(pair_table.name)]
+        if index.name in existing_names:
+            return
+
+        logger.debug("Create index %s..." % index.name)
+        try:
+            index.create(engine)
+        except DBAPIError as e:
+            # Another process may have created it in the meantime
+            logger.warning("Could not create index %s: %s" %
+                           (index.name, str(e)))
+
+    def close(self):
+        """Close all pooled connections, tables are reopened when needed
+
+        Must be called in child processes before they use a Database
+        inherited through fork.
+        """
+        if self._engine is not None:
+            self._engine.dispose()
+        self._engine = None
+        self._dbs = {}
 
+    def _validate_table_name(self, table_name):
         if "-" in table_name:
             raise ValueError("Invalid character for table name: -")
+
+    def get_engine_string(self):
+        if self.backend == "sqlite":
+            return SQLITE_ENGINE_STRING_TEMPLATE % dict(path=self.path)
+
+        return (ENGINE_STRING_TEMPLATE %
+                dict(username=self.username,
+                     password=self.password,
+                     database_address=self.address,
+                     database_name=self.name))
+
+    def get_db_string(self, table_name):
+
+        self._validate_table_name(table_name)
+
+        if self.backend == "sqlite":
+            return (SQLITE_DB_STRING_TEMPLATE %
+                    dict(path=self.path, table_name=table_name))
+
         return (DB_STRING_TEMPLATE %
                 dict(username=self.username,
                      password=self.password,
@@ -61,38 +655,224 @@ class Database(object):
                      database_name=self.name,
                      table_name=table_name))
 
-    def update(self, table_name, rows, update_dict):
+    @_timed
+    @_invalidates_cache
+    def update(self, table_name, rows, update_dict, filter_eq_dct=None,
+               chunk_size=CHUNK_SIZE, progress=None, return_ids=False):
+        """Apply update_dict to given rows, or to rows matching filter_eq_dct
+
+        If both rows and filter_eq_dct are given, only given rows which
+        still match filter_eq_dct in the transaction of their chunk are
+        updated. Rows are updated by chunks of `chunk_size` ids with a few
+        set-based statements per chunk, each chunk being commited
+        separately. A chunk which fails is rolled back and reported without
+        stopping the others. If given, progress(nb_of_processed_rows,
+        nb_of_rows) is called after each chunk.
+
+        Returns the number of rows updated, or their ids if return_ids is
+        True, and the list of ids which failed.
+        """
         db = self._open_db(table_name)
+        flat_update_dict = flatten(update_dict)
 
-        with SafeSession(db) as safe_session:
+        updated_ids, failed_ids = self._process_chunks(
+            db, rows, filter_eq_dct, chunk_size, progress, "update",
+            lambda session, ids: self._update_and_mark_ids(
+                db, session, ids, flat_update_dict))
+
+        if return_ids:
+            return updated_ids, failed_ids
+
+        return len(updated_ids), failed_ids
+
+    def _process_chunks(self, db, rows, filter_eq_dct, chunk_size, progress,
+                        action, process_ids):
+
+        processed_ids = []
+        failed_ids = []
+
+        with _write_transactions(), SafeSession(db) as safe_session:
             with safe_session.set_timer(60 * 5):
-                for row in rows:
-                    sql_row = self._load_in_safe_session(
-                        db=db, safe_session=safe_session, row_id=row['id'])[0]
-                    try:
-                        sql_row.update_simple(flatten(update_dict), safe_session.session)
-                    except:
-                        sys.stderr.write("Failed for row: %d\n" % row['id'])
-                safe_session.session.commit()
-
-    def delete(self, table_name, rows):
+                nb_of_rows = self._count_ids(db, safe_session, rows,
+                                             filter_eq_dct)
+
+            chunks = self._iter_id_chunks(db, safe_session, rows,
+                                          filter_eq_dct, chunk_size)
+            for ids in chunks:
+                try:
+                    with safe_session.set_timer(60 * 5):
+                        matching_ids = ids
+                        if rows is not None and filter_eq_dct is not None:
+                            matching_ids = self._filter_ids(
+                                db, safe_session.session, ids, filter_eq_dct)
+                        if len(matching_ids) > 0:
+                            process_ids(safe_session.session, matching_ids)
+                        safe_session.commit()
+                except SessionInterrupted:
+                    raise
+                except Exception as e:
+                    safe_session.session.rollback()
+                    failed_ids += ids
+                    sys.stderr.write("Failed to %s rows %d to %d: %s\n" %
+                                     (action, ids[0], ids[-1], str(e)))
+                else:
+                    processed_ids += matching_ids
+
+                logger.debug("%s: %d/%d rows done" %
+                             (action, len(processed_ids) + len(failed_ids),
+                              nb_of_rows))
+                if progress is not None:
+                    progress(len(processed_ids) + len(failed_ids),
+                             nb_of_rows)
+
+        return processed_ids, failed_ids
+
+    def _filter_ids(self, db, session, ids, filter_eq_dct):
+        """Ids among ids of rows matching filter_eq_dct
+
+        On Postgres, the key/value pairs of filtered keys are locked first
+        so that they do not change until the end of the transaction, the
+        following select then sees their last committed values.
+        """
+        dict_table, pair_table = _tables(db)
+
+        if session.bind.dialect.name == "postgresql":
+            session.execute(
+                select([pair_table.c.dict_id])
+                .where(and_(pair_table.c.dict_id.in_(ids),
+                            pair_table.c.name.in_(filter_eq_dct.keys())))
+                .with_for_update())
+
+        return [row_id for row_id, in
+                session.query(db._Dict.id)
+                .filter(db._Dict.id.in_(ids))
+                .filter(*_filter_clauses(db, filter_eq_dct))
+                .order_by(db._Dict.id)]
+
+    def _count_ids(self, db, safe_session, rows, filter_eq_dct):
+        if rows is not None and filter_eq_dct is not None:
+            ids = [row["id"] for row in rows]
+            return sum(
+                safe_session.session.query(func.count(db._Dict.id))
+                .filter(db._Dict.id.in_(ids[i:i + CHUNK_SIZE]))
+                .filter(*_filter_clauses(db, filter_eq_dct))
+                .scalar()
+                for i in xrange(0, len(ids), CHUNK_SIZE))
+        elif rows is not None:
+            return len(rows)
+
+        return (safe_session.session.query(func.count(db._Dict.id))
+                .filter(*_filter_clauses(db, filter_eq_dct))
+                .scalar())
+
+    def _iter_id_chunks(self, db, safe_session, rows, filter_eq_dct,
+                        chunk_size):
+        if rows is not None:
+            ids = sorted(row["id"] for row in rows)
+            for i in xrange(0, len(ids), chunk_size):
+                yield ids[i:i + chunk_size]
+            return
+
+        # Keyset pagination, rows updated or deleted from previous chunks
+        # do not offset the next ones
+        clauses = _filter_clauses(db, filter_eq_dct)
+        last_id = None
+        while True:
+            ids = self._query_ids_page(db, safe_session.session, clauses,
+                                       last_id, False, chunk_size)
+            if len(ids) == 0:
+                return
+            last_id = ids[-1]
+            yield ids
+
+    def _query_ids_page(self, db, session, clauses, last_id, descending,
+                        page_size):
+        query = session.query(db._Dict.id).filter(*clauses)
+        if last_id is not None and descending:
+            query = query.filter(db._Dict.id < last_id)
+        elif last_id is not None:
+            query = query.filter(db._Dict.id > last_id)
+
+        if descending:
+            query = query.order_by(db._Dict.id.desc())
+        else:
+            query = query.order_by(db._Dict.id)
+
+        return [row_id for row_id, in query.limit(page_size)]
+
+    def _delete_ids(self, db, session, ids):
+        dict_table, pair_table = _tables(db)
+
+        session.execute(pair_table.delete()
+                        .where(pair_table.c.dict_id.in_(ids)))
+        session.execute(dict_table.delete()
+                        .where(dict_table.c.id.in_(ids)))
+
+    def _update_and_mark_ids(self, db, session, ids, flat_update_dict):
+        self._update_ids(db, session, ids, flat_update_dict)
+        _mark_updated(db, session, ids)
+
+    def _update_ids(self, db, session, ids, flat_update_dict):
+        dict_table, pair_table = _tables(db)
+
+        mirrored_values = dict()
+        for key, value in flat_update_dict.iteritems():
+            columns = _encode_value(db, key, value)
+
+            session.execute(
+                pair_table.update()
+                .where(and_(pair_table.c.name == key,
+                            pair_table.c.dict_id.in_(ids)))
+                .values(**columns))
+
+            missing_rows = select(
+                [dict_table.c.id, literal(key, type_=pair_table.c.name.type)] +
+                [null() if columns[column] is None else
+                 literal(columns[column], type_=pair_table.c[column].type)
+                 for column in VALUE_COLUMNS]).where(and_(
+                     dict_table.c.id.in_(ids),
+                     ~exists().where(and_(
+                         pair_table.c.dict_id == dict_table.c.id,
+                         pair_table.c.name == key))))
+            session.execute(pair_table.insert().from_select(
+                ["dict_id", "name"] + VALUE_COLUMNS, missing_rows))
+
+            if key in MIRRORED_COLUMNS:
+                mirrored_values[MIRRORED_COLUMNS[key]] = value
+
+        if len(mirrored_values) > 0:
+            session.execute(dict_table.update()
+                            .where(dict_table.c.id.in_(ids))
+                            .values(**mirrored_values))
+
+    @_timed
+    @_invalidates_cache
+    def delete(self, table_name, rows, filter_eq_dct=None,
+               chunk_size=CHUNK_SIZE, progress=None):
+        """Delete given rows, or rows matching filter_eq_dct
+
+        Rows and their key/value pairs are deleted by chunks of `chunk_size`
+        ids with set-based statements, each chunk being commited separately,
+        hence an interrupted deletion can simply be run again to complete
+        it. Rows are never loaded. Failures and progress are reported as for
+        update().
+
+        Returns the number of rows deleted and the list of ids which failed.
+        """
         db = self._open_db(table_name)
 
-        with SafeSession(db) as safe_session:
-            with safe_session.set_timer(60 * 5):
-                for row in rows:
-                    try:
-                        sql_row = self._load_in_safe_session(
-                            db=db, safe_session=safe_session, row_id=row['id'])[0]
-                        sql_row.delete(safe_session.session)
-                    except:
-                        sys.stderr.write("Failed for row: %d\n" % row['id'])
-                safe_session.session.commit()
+        deleted_ids, failed_ids = self._process_chunks(
+            db, rows, filter_eq_dct, chunk_size, progress, "delete",
+            lambda session, ids: self._delete_ids(db, session, ids))
 
+        return len(deleted_ids), failed_ids
+
+    @_timed
+    @_invalidates_cache
     def save(self, table_name, row):
         db = self._open_db(table_name)
 
-        with SafeSession(db) as safe_session:
+        with _write_transactions(), SafeSession(db) as safe_session:
 
             if "id" in row:
                 row_id = row["id"]
@@ -116,56 +896,508 @@ class Database(object):
             row_id = sql_row.id
 
             with safe_session.set_timer(60 * 5):
-                safe_session.session.commit()
+                safe_session.session.flush()
+                _mark_updated(db, safe_session.session, [row_id])
+                safe_session.commit()
                 logger.debug("session commited")
 
         # load in new session otherwise lazy attribute selection hangs
         # on forever... why is that!?
         with SafeSession(db) as safe_session:
-            sql_row = self._load_in_safe_session(db, safe_session,
-                                                 row_id=row_id)[0]
             logger.debug("Fetch all row attributes...")
-            eager_dict = self._eager_dicts([sql_row], safe_session)[0]
+            eager_dict = self._eager_dicts(db, [row_id], safe_session)[0]
             logger.debug("Fetch done")
 
             eager_dict['id'] = row_id
 
         return eager_dict
 
-    def _eager_dicts(self, lazy_sql_rows, safe_session):
-        eager_dicts = [None] * len(lazy_sql_rows)
+    @_timed
+    @_invalidates_cache
+    def save_many(self, table_name, rows, batch_size=CHUNK_SIZE,
+                  priority=1.0):
+        """Insert new rows by batches in a single transaction
+
+        rows can be any iterable, it is consumed one batch at a time. Rows
+        whose jobman hash is already in the table, or earlier in rows, are
+        not inserted again. Inserted rows are not reloaded.
+
+        Returns the ids of the rows in the order of `rows`, a duplicate
+        getting the id of the row it duplicates.
+        """
+        db = self._open_db(table_name)
+
+        ids = []
+        with _write_transactions(), SafeSession(db) as safe_session:
+            for batch in _iter_batches(rows, batch_size):
+                with safe_session.set_timer(60 * 5):
+                    ids += self._insert_batch(db, safe_session.session, batch,
+                                              priority)
+                logger.debug("%d rows saved" % len(ids))
+
+            with safe_session.set_timer(60 * 5):
+                safe_session.commit()
+                logger.debug("session commited")
+
+        return ids
+
+    def _insert_batch(self, db, session, rows, priority):
+        dict_table, pair_table = _tables(db)
+
+        flat_rows = [flatten(row) for row in rows]
+        hashcodes = [sql.hash_state(flat_row) for flat_row in flat_rows]
+
+        ids = dict(session.query(db._Dict.hash, db._Dict.id)
+                   .filter(db._Dict.hash.in_(set(hashcodes))))
+
+        new_rows = []
+        new_hashcodes = set()
+        for flat_row, hashcode in zip(flat_rows, hashcodes):
+            if hashcode not in ids and hashcode not in new_hashcodes:
+                new_rows.append((hashcode, flat_row))
+                new_hashcodes.add(hashcode)
+
+        if len(new_rows) == 0:
+            return [ids[hashcode] for hashcode in hashcodes]
+
+        dict_rows = [dict(status=sql.START, priority=priority, hash=hashcode)
+                     for hashcode, flat_row in new_rows]
+        if session.bind.dialect.name == "postgresql":
+            result = session.execute(
+                dict_table.insert().values(dict_rows)
+                .returning(dict_table.c.hash, dict_table.c.id))
+            ids.update(result.fetchall())
+        else:
+            for dict_row in dict_rows:
+                result = session.execute(dict_table.insert().values(**dict_row))
+                ids[dict_row["hash"]] = result.inserted_primary_key[0]
+
+        pair_rows = []
+        for hashcode, flat_row in new_rows:
+            flat_row = dict(flat_row)
+            flat_row.update({sql.STATUS: sql.START, sql.HASH: hashcode,
+                             sql.PRIORITY: priority,
+                             sql.JOBID: ids[hashcode]})
+            for key, value in flat_row.iteritems():
+                pair_row = _encode_value(db, key, value)
+                pair_row.update(dict_id=ids[hashcode], name=key)
+                pair_rows.append(pair_row)
+
+        session.execute(pair_table.insert(), pair_rows)
+
+        return [ids[hashcode] for hashcode in hashcodes]
+
+    def _eager_dicts(self, db, ids, safe_session, fields=None):
+        """Fetch rows of given ids as nested dicts
+
+        Key/value pairs of all rows are fetched with one query per chunk of
+        ids and pivoted in memory, rather than lazily loaded row by row. If
+        fields is given only matching keys are fetched, see load().
+        """
+        flat_dicts = dict((row_id, dict()) for row_id in ids)
+
         with safe_session.set_timer(60 * 5):
-            for i, lazy_sql_row in enumerate(lazy_sql_rows):
-                eager_dicts[i] = expand(dict(lazy_sql_row.iteritems()))
+            for batch in _iter_batches(ids, CHUNK_SIZE):
+                key_values = (safe_session.session.query(db._KeyVal)
+                              .filter(db._KeyVal.dict_id.in_(batch)))
+                if fields is not None:
+                    key_values = key_values.filter(
+                        _fields_clause(db, list(fields) + [sql.JOBID]))
+                for key_value in key_values:
+                    flat_dicts[key_value.dict_id][key_value.name] = \
+                        key_value.val
 
-        return eager_dicts
+                # Pivoted pairs are not needed by the session anymore
+                safe_session.session.expunge_all()
+
+        return [expand(flat_dicts[row_id]) for row_id in ids]
+
+    @_timed
+    def load(self, table_name, filter_eq_dct=None, row_id=None, hash_of=None,
+             fields=None, cache=True):
+        """Load rows as nested dicts
+
+        If fields is given, only the keys of these fields, and the row id,
+        are fetched. Fields are given by their flattened name, for instance
+        `jobman.status` or `jobman` which selects all keys nested in it.
+
+        Results are cached until they time out or rows of the table are
+        written through this Database, unless cache is False.
+        """
+        if not cache:
+            return self._load(table_name, filter_eq_dct, row_id, hash_of,
+                              fields)
+
+        key = json.dumps([filter_eq_dct, row_id, hash_of, fields],
+                         sort_keys=True, default=repr)
+        return self.cache.get(
+            table_name, key,
+            lambda: self._load(table_name, filter_eq_dct, row_id, hash_of,
+                               fields))
 
-    def load(self, table_name, filter_eq_dct=None, row_id=None, hash_of=None):
+    def _load(self, table_name, filter_eq_dct, row_id, hash_of, fields):
         db = self._open_db(table_name)
 
         with SafeSession(db) as safe_session:
 
-            sql_rows = self._load_in_safe_session(
+            ids = self._load_ids_in_safe_session(
                 db, safe_session, filter_eq_dct, row_id, hash_of)
 
             logger.debug("Fetch all row attributes...")
-            eager_dicts = self._eager_dicts(sql_rows, safe_session)
+            eager_dicts = self._eager_dicts(db, ids, safe_session,
+                                            fields=fields)
             logger.debug("Fetch done")
 
-        for eager_dict in eager_dicts:
+        for row_id, eager_dict in zip(ids, eager_dicts):
             try:
                 eager_dict['id'] = eager_dict['jobman']['id']
             except KeyError:
+                if fields is not None:
+                    # Partial rows cannot be reinserted
+                    eager_dict['id'] = row_id
+                    continue
                 logger.warning("Row id is broken, deleting and reinserting")
-                self.delete(table_name, eager_dict)
-                if "id" in eager_dict:
-                    logger.debug("%d\n" % eager_dict["id"])
-                    del eager_dict["id"]
+                self.delete(table_name, [dict(id=row_id)])
                 eager_dict.update(self.save(table_name, eager_dict))
                 logger.debug("%d\n" % eager_dict["id"])
 
         return eager_dicts
 
+    @_timed
+    @_invalidates_cache
+    def claim(self, table_name, nb_of_rows=1, filter_eq_dct=None,
+              hash_of=None, fields=None, update_dict=None):
+        """Move up to nb_of_rows pending rows to running, return them
+
+        Rows are claimed atomically: a row is never returned to two callers.
+        On Postgres, rows being claimed by concurrent callers are skipped
+        (SELECT ... FOR UPDATE SKIP LOCKED) rather than waited for, locked
+        rows are then claimed with a compare-and-set on their status pair.
+        Other backends, like SQLite for local tests, claim rows one by one
+        with a compare-and-set on their status pair. As with `jobman sql`,
+        rows of highest priority are claimed first. Candidates can be
+        restricted with filter_eq_dct or hash_of as in load(), fields also
+        behaves as in load(). Values of update_dict are set on claimed rows
+        in the same transaction.
+        """
+        db = self._open_db(table_name)
+
+        clauses = _filter_clauses(db, filter_eq_dct)
+        if hash_of is not None:
+            clauses.append(db.status_table.c.hash ==
+                           sql.hash_state(flatten(hash_of)))
+
+        flat_update_dict = flatten(update_dict or {})
+        flat_update_dict[sql.STATUS] = sql.RUNNING
+
+        with _write_transactions(), SafeSession(db) as safe_session:
+            session = safe_session.session
+            with safe_session.set_timer(60 * 5):
+                if session.bind.dialect.name == "postgresql":
+                    ids = self._compare_and_set_ids(
+                        db, session, self._lock_pending_ids(
+                            db, session, clauses, nb_of_rows))
+                else:
+                    ids = self._compare_and_set_pending_ids(
+                        db, session, clauses, nb_of_rows)
+
+                if len(ids) > 0:
+                    self._update_ids(db, session, ids, flat_update_dict)
+                safe_session.commit()
+                logger.debug("Claimed rows %s" % str(ids))
+
+        with SafeSession(db) as safe_session:
+            eager_dicts = self._eager_dicts(db, ids, safe_session,
+                                            fields=fields)
+
+        for row_id, eager_dict in zip(ids, eager_dicts):
+            eager_dict['id'] = row_id
+
+        return eager_dicts
+
+    @_timed
+    def touch(self, table_name, ids, key, value):
+        """Set key to value on given row ids in one short transaction
+
+        Lightweight write path for frequent updates such as heartbeats: rows
+        are not loaded and the cache is not invalidated, loaded rows may show
+        the previous value until their cache entry expires.
+        """
+        if len(ids) == 0:
+            return
+
+        db = self._open_db(table_name)
+
+        with _write_transactions(), SafeSession(db) as safe_session:
+            with safe_session.set_timer(60):
+                self._update_ids(db, safe_session.session, ids, {key: value})
+                safe_session.commit()
+
+    @_timed
+    def stale_ids(self, table_name, key, before, filter_eq_dct=None):
+        """Ids of rows whose float value of key is lower than before
+
+        Rows without key are not returned. The lookup is served by the
+        (name, fval) index of the key/value table.
+        """
+        db = self._open_db(table_name)
+
+        clauses = _filter_clauses(db, filter_eq_dct)
+
+        with SafeSession(db) as safe_session:
+            with safe_session.set_timer(60 * 5):
+                query = (safe_session.session.query(db._KeyVal.dict_id)
+                         .join(db._Dict, db._Dict.id == db._KeyVal.dict_id)
+                         .filter(db._KeyVal.name == key,
+                                 db._KeyVal.fval < before)
+                         .filter(*clauses)
+                         .order_by(db._KeyVal.dict_id))
+
+                return [row_id for row_id, in query]
+
+    @_timed
+    def rebuild_status(self, table_name):
+        """Rebuild the status table of table_name from its key/value pairs
+
+        Needed once for tables written before their status table had
+        triggers, it also drops rows left by deletions. Returns the number
+        of rows.
+        """
+        db = self._open_db(table_name)
+
+        return self._rebuild_status(db)
+
+    def _rebuild_status(self, db):
+        logger.info("Rebuild table %s..." % db.status_table.name)
+        with _write_transactions(), SafeSession(db) as safe_session:
+            session = safe_session.session
+            with safe_session.set_timer(60 * 30):
+                session.execute(db.status_table.delete())
+                session.execute(db.status_table.insert().from_select(
+                    ["id", "status", "hash", "priority", "updated_at"],
+                    _select_status_rows(db, session.bind.dialect)))
+                nb_of_rows = session.query(
+                    func.count(db.status_table.c.id)).scalar()
+                safe_session.commit()
+        logger.info("Rebuilt %d rows" % nb_of_rows)
+
+        return nb_of_rows
+
+    @_timed
+    def status_changes(self, table_name, since=None):
+        """Status rows updated after since, all current rows if None
+
+        Returns a list of (id, status, updated_at) ordered by updated_at.
+        Deleted rows have a None status. The lookup is served by the
+        updated_at index, its cost depends on the number of changes only.
+        """
+        db = self._open_db(table_name)
+        status_table = db.status_table
+
+        with SafeSession(db) as safe_session:
+            with safe_session.set_timer(60 * 5):
+                query = safe_session.session.query(
+                    status_table.c.id, status_table.c.status,
+                    status_table.c.updated_at)
+                if since is None:
+                    query = query.filter(status_table.c.status != null())
+                else:
+                    query = query.filter(status_table.c.updated_at > since)
+
+                return query.order_by(status_table.c.updated_at).all()
+
+    def _query_pending_ids(self, db, session, clauses, nb_of_rows):
+        status_table = db.status_table
+        return (session.query(status_table.c.id)
+                .join(db._Dict, db._Dict.id == status_table.c.id)
+                .filter(status_table.c.status == sql.START)
+                .filter(*clauses)
+                .order_by(status_table.c.priority.desc(),
+                          status_table.c.id)
+                .limit(nb_of_rows))
+
+    def _lock_pending_ids(self, db, session, clauses, nb_of_rows):
+        preparer = session.bind.dialect.identifier_preparer
+
+        statement = (self._query_pending_ids(db, session, clauses, nb_of_rows)
+                     .statement
+                     .suffix_with("FOR UPDATE OF %s SKIP LOCKED" %
+                                  preparer.format_table(db.status_table)))
+
+        return [row_id for row_id, in session.execute(statement)]
+
+    def _compare_and_set_ids(self, db, session, ids):
+        """Set the status of rows still pending to running, return their ids
+
+        Rows whose status pair was changed by a writer which does not go
+        through Database, e.g. `jobman sql`, are left out.
+        """
+        if len(ids) == 0:
+            return ids
+
+        dict_table, pair_table = _tables(db)
+        running = _encode_value(db, sql.STATUS, sql.RUNNING)
+
+        result = session.execute(
+            pair_table.update()
+            .where(and_(pair_table.c.dict_id.in_(ids),
+                        pair_table.c.name == sql.STATUS,
+                        pair_table.c.ival == sql.START))
+            .values(**running)
+            .returning(pair_table.c.dict_id))
+        claimed_ids = set(row_id for row_id, in result)
+
+        return [row_id for row_id in ids if row_id in claimed_ids]
+
+    def _compare_and_set_pending_ids(self, db, session, clauses, nb_of_rows):
+        dict_table, pair_table = _tables(db)
+        running = _encode_value(db, sql.STATUS, sql.RUNNING)
+
+        # Once a row is updated the transaction holds the write lock,
+        # candidates selected afterwards cannot be claimed by others
+        ids = []
+        while len(ids) < nb_of_rows:
+            candidates = [row_id for row_id, in self._query_pending_ids(
+                db, session, clauses, nb_of_rows - len(ids))]
+            if len(candidates) == 0:
+                break
+
+            for row_id in candidates:
+                result = session.execute(
+                    pair_table.update()
+                    .where(and_(pair_table.c.dict_id == row_id,
+                                pair_table.c.name == sql.STATUS,
+                                pair_table.c.ival == sql.START))
+                    .values(**running))
+                if result.rowcount == 1:
+                    ids.append(row_id)
+                else:
+                    # Out of date status row, it must not be selected again
+                    _refresh_status(db, session, [row_id])
+
+        return ids
+
+    def iterate(self, table_name, filter_eq_dct=None, order_by="id",
+                limit=None, page_size=CHUNK_SIZE, fields=None):
+        """Iterate over rows without holding more than a page in memory
+
+        Pages are selected server side with keyset pagination on row ids,
+        order_by being either "id" or "-id" for descending order. At most
+        `limit` rows are produced if it is given. fields are handled as in
+        load().
+        """
+        for ids in self.iterate_ids(table_name, filter_eq_dct, order_by,
+                                    limit, page_size):
+            for row in self._load_ids(table_name, ids, fields):
+                yield row
+
+    def iterate_ids(self, table_name, filter_eq_dct=None, order_by="id",
+                    limit=None, page_size=CHUNK_SIZE):
+        """Iterate over pages of row ids, see iterate()"""
+
+        if order_by not in ["id", "-id"]:
+            raise ValueError("Rows can only be ordered by id or -id, not %s" %
+                             order_by)
+        descending = order_by.startswith("-")
+
+        db = self._open_db(table_name)
+        clauses = _filter_clauses(db, filter_eq_dct)
+
+        nb_of_rows = 0
+        last_id = None
+        while limit is None or nb_of_rows < limit:
+            if limit is not None:
+                page_size = min(page_size, limit - nb_of_rows)
+
+            with SafeSession(db) as safe_session:
+                with safe_session.set_timer(60 * 5):
+                    ids = self._query_ids_page(db, safe_session.session,
+                                               clauses, last_id, descending,
+                                               page_size)
+            if len(ids) == 0:
+                return
+
+            nb_of_rows += len(ids)
+            last_id = ids[-1]
+            yield ids
+
+    def _load_ids(self, table_name, ids, fields=None):
+        db = self._open_db(table_name)
+
+        with SafeSession(db) as safe_session:
+            eager_dicts = self._eager_dicts(db, ids, safe_session,
+                                            fields=fields)
+
+        for row_id, eager_dict in zip(ids, eager_dicts):
+            eager_dict['id'] = row_id
+
+        return eager_dicts
+
+    @_timed
+    def count_by_status(self, table_name, sample_size=0):
+        """Count rows per jobman status without loading them
+
+        Returns a dict mapping each status found in the table to a tuple
+        (count, ids) where ids holds at most `sample_size` of the smallest
+        row ids having that status.
+        """
+        db = self._open_db(table_name)
+        status_table = db.status_table
+
+        with SafeSession(db) as safe_session:
+            with safe_session.set_timer(60 * 5):
+                logger.debug("Count rows by status...")
+                counts = (safe_session.session
+                          .query(status_table.c.status,
+                                 func.count(status_table.c.id))
+                          .filter(status_table.c.status != null())
+                          .group_by(status_table.c.status)
+                          .all())
+
+                samples = dict((status, []) for status, count in counts)
+                if sample_size > 0 and len(counts) > 0:
+                    row_number = func.row_number().over(
+                        partition_by=status_table.c.status,
+                        order_by=status_table.c.id).label("row_number")
+                    ranked = (safe_session.session
+                              .query(status_table.c.status.label("status"),
+                                     status_table.c.id.label("id"),
+                                     row_number)
+                              .filter(status_table.c.status != null())
+                              .subquery())
+                    sampled_rows = (safe_session.session
+                                    .query(ranked.c.status, ranked.c.id)
+                                    .filter(ranked.c.row_number <= sample_size)
+                                    .order_by(ranked.c.status, ranked.c.id))
+                    for status, row_id in sampled_rows:
+                        samples[status].append(row_id)
+                logger.debug("Count done")
+
+        return dict((status, (count, samples[status]))
+                    for status, count in counts)
+
+    def _load_ids_in_safe_session(self, db, safe_session, filter_eq_dct=None,
+                                  row_id=None, hash_of=None):
+
+        with safe_session.set_timer(60 * 5):
+            logger.debug("Query session...")
+            q = safe_session.session.query(db._Dict.id)
+            if row_id is not None:
+                ids = [row_id for row_id, in q.filter(db._Dict.id == row_id)]
+                if len(ids) == 0:
+                    raise OperationalError("There is no rows with id \"%d\"" % row_id)
+            elif hash_of is not None:
+                hashcode = sql.hash_state(flatten(hash_of))
+                ids = [row_id for row_id, in
+                       q.filter(db._Dict.hash == hashcode)]
+            else:
+                ids = [row_id for row_id, in
+                       q.filter(*_filter_clauses(db, filter_eq_dct))
+                       .order_by(db._Dict.id)]
+            logger.debug("Query done")
+
+        return ids
+
     def _load_in_safe_session(self, db, safe_session,
                               filter_eq_dct=None, row_id=None, hash_of=None):
 
@@ -181,7 +1413,8 @@ class Database(object):
                 hashcode = sql.hash_state(flatten(hash_of))
                 sql_rows = q._query.filter(db._Dict.hash == hashcode).all()
             elif filter_eq_dct is not None:
-                sql_rows = q.filter_eq_dct(filter_eq_dct).all()
+                sql_rows = q._query.filter(
+                    *_filter_clauses(db, filter_eq_dct)).all()
             else:
                 sql_rows = q.all()
             logger.debug("Query done")
@@ -1,23 +1,29 @@
 import argparse
 import copy
 import logging
+import multiprocessing
 import os
-import pwd
 import random
 import re
+import resource
+import signal
 import sys
+import threading
 import time
 
 from jobman import sql
 from jobman.channel import Channel
 from jobman.tools import expand, resolve
 
-from distributed_jobman import get_db_string
+from distributed_jobman import config, get_db_string, metrics
+from distributed_jobman.database import database
 import observer
 from plot import plot
+from process import ProcessError
 import schedulers.jobs as job_scheduler
 import schedulers.experiments as experiment_scheduler
-from utils import bold, query_yes_no, load_json, ChangeDir
+from utils import bold, query_yes_no, load_json, ChangeDir, TokenBucket
+from utils import SessionInterrupted
 
 logger = logging.getLogger("main")
 LOGGING_FORMAT = "%(asctime)-15s %(levelname)s:%(name)s:%(filename)-20s %(message)s"
@@ -30,6 +36,11 @@ SET = "set"
 RESET = "reset"
 REMOVE = "remove"
 PLOT = "plot"
+DAEMON = "daemon"
+WORKER = "worker"
+REAP = "reap"
+REBUILD = "rebuild"
+IDS = "ids"
 
 
 def get_options(argv):
@@ -42,6 +53,10 @@ def get_options(argv):
     parser.add_argument("-v", "--verbose", action="store_true", help="""
         WRITEME""")
 
+    parser.add_argument("--stats", action="store_true", help="""
+        Print a JSON summary of database, scheduler and submission timings
+        before exiting""")
+
     subparsers = parser.add_subparsers(dest='command')
     launch_parser = subparsers.add_parser(LAUNCH)
     run_parser = subparsers.add_parser(RUN)
@@ -51,8 +66,14 @@ def get_options(argv):
     reset_parser = subparsers.add_parser(RESET)
     remove_parser = subparsers.add_parser(REMOVE)
     plot_parser = subparsers.add_parser(PLOT)
-
-    for subparser in [launch_parser, monitor_parser, list_parser]:
+    daemon_parser = subparsers.add_parser(DAEMON)
+    worker_parser = subparsers.add_parser(WORKER)
+    reap_parser = subparsers.add_parser(REAP)
+    rebuild_parser = subparsers.add_parser(REBUILD)
+    ids_parser = subparsers.add_parser(IDS)
+
+    for subparser in [launch_parser, monitor_parser, list_parser,
+                      daemon_parser, reap_parser, rebuild_parser]:
         subparser.add_argument("-c", "--cluster", default=None, help="""
             WRITEME""")
 
@@ -62,6 +83,77 @@ def get_options(argv):
         Limit the number of jobs that can be launched""")
     launch_parser.add_argument("-e", "--experiment", help="""
         Only launch the given experiment name""")
+    launch_parser.add_argument("-w", "--workers", action="store_true",
+                               help="""
+        Submit workers running pending jobs until none is left instead of
+        one job per submission""")
+
+    # List parser arguments
+
+    list_parser.add_argument("-w", "--watch", action="store_true", help="""
+        Redraw the list in place every interval seconds, fetching only jobs
+        changed since the previous update""")
+    list_parser.add_argument("-i", "--interval", type=float, default=10,
+                             help="""
+        Seconds between two updates of --watch""")
+
+    # Daemon parser arguments
+
+    daemon_parser.add_argument("-l", "--limit", type=int, default=0, help="""
+        Limit the number of jobs that can be launched per experiment and
+        cycle""")
+    daemon_parser.add_argument("-e", "--experiment", help="""
+        Only launch the given experiment name""")
+    daemon_parser.add_argument("-i", "--interval", type=float, default=60,
+                               help="""
+        Seconds between the start of two launch cycles""")
+    daemon_parser.add_argument("-d", "--deadline", type=float, default=None,
+                               help="""
+        Seconds after which a cycle stops submitting jobs, defaults to the
+        interval""")
+    daemon_parser.add_argument("-w", "--workers", action="store_true",
+                               help="""
+        Submit workers running pending jobs until none is left instead of
+        one job per submission""")
+    daemon_parser.add_argument("-r", "--reap", action="store_true", help="""
+        Set running jobs with a stale heartbeat back to pending before each
+        cycle""")
+
+    # Reap parser arguments
+
+    reap_parser.add_argument("-e", "--experiment", help="""
+        Only reap jobs of the given experiment name""")
+    reap_parser.add_argument("-t", "--timeout", type=float, default=None,
+                             help="""
+        Seconds without heartbeat after which a running job is stale,
+        defaults to stale_timeout of the worker section of the configuration
+        file""")
+
+    # Rebuild parser arguments
+
+    rebuild_parser.add_argument("-e", "--experiment", help="""
+        Only rebuild the status table of the given experiment name""")
+
+    # Worker parser arguments
+
+    worker_parser.add_argument("experiment_name", help="""
+        Name of the experiment whose pending jobs are run""")
+    worker_parser.add_argument("-f", "--function", default=None, help="""
+        Path of the module defining jobman_main, as for the run command.
+        Defaults to the function saved in each job (jobman.experiment)""")
+    worker_parser.add_argument("-i", "--idle-timeout", type=float,
+                               default=60, help="""
+        Seconds without any pending job after which the worker stops""")
+    worker_parser.add_argument("-b", "--budget", type=float, default=None,
+                               help="""
+        Seconds after which the worker does not start new jobs""")
+    worker_parser.add_argument("-r", "--root", default=".", help="""
+        Directory where the working directory of each job is created""")
+    worker_parser.add_argument("-k", "--pack", type=int, default=1, help="""
+        Number of worker processes sharing the allocation""")
+    worker_parser.add_argument("-m", "--pack-mem", type=int, default=0,
+                               help="""
+        Memory cap of each packed worker process in MB, 0 for none""")
 
     # Run parser arguments
 
@@ -98,6 +190,20 @@ def get_options(argv):
     remove_parser.add_argument("name", help="""
         WRITEME""")
 
+    # Ids parser arguments
+
+    ids_parser.add_argument("experiment_name", help="""
+        Name of the experiment whose job ids are printed""")
+    ids_parser.add_argument(
+        "job_status", nargs="?", default=None,
+        choices=["pending", "running", "completed", "broken"], help="""
+            Only print ids of jobs with this status""")
+    ids_parser.add_argument("-n", "--number", type=int, default=None,
+                            help="""
+        Print at most this number of ids, all by default""")
+    ids_parser.add_argument("--last", action="store_true", help="""
+        Print the largest ids first""")
+
     # Plot parser arguments
 
     plot_parser.add_argument("experiment_name", help="""
@@ -105,6 +211,10 @@ def get_options(argv):
 
     options = parser.parse_args(argv)
 
+    # Ids are printed alone to be piped to other commands
+    if options.command == IDS:
+        return options
+
     if options.cluster:
         print "------------------------%s" % ("-" * len(options.cluster))
         print "Experiments for cluster %s" % bold(options.cluster)
@@ -117,10 +227,9 @@ def get_options(argv):
     return options
 
 
-def _format_ids(jobs, show_maximum=20):
-    ids = [str(job["id"]) for job in jobs]
-    ids_string = ", ".join(sorted(ids)[:show_maximum])
-    if len(ids) > show_maximum:
+def _format_ids(ids, nb_of_ids, show_maximum=20):
+    ids_string = ", ".join(str(job_id) for job_id in ids[:show_maximum])
+    if nb_of_ids > show_maximum:
         ids_string += ", ..."
 
     return ids_string
@@ -133,45 +242,105 @@ def list_experiments(cluster):
         print "No experiments in database %s" % get_db_string("experiments")
 
     for experiment in experiments:
-        print "Name:", bold(experiment["name"])
-        print "  Id: %d" % experiment["jobman"]["id"]
-        for key in ["table", "gpu"]:
-            print "      %s = %s" % (key, str(experiment[key]))
-
-        for name, cluster in experiment["clusters"].iteritems():
-            print "      %s:" % name
-            for key, value in sorted(cluster.iteritems()):
-                print "          %s = %s" % (key, value)
-
+        print "\n".join(_format_experiment(experiment))
         list_jobs(experiment["table"])
         print
 
 
-def list_jobs(table_name):
-    jobs = job_scheduler.load_jobs(table_name)
-    waiting_jobs = []
-    running_jobs = []
-    completed_jobs = []
-    broken_jobs = []
-    for job in jobs:
-        if job_scheduler.is_pending(job):
-            waiting_jobs.append(job)
-        elif job_scheduler.is_running(job):
-            running_jobs.append(job)
-        elif job_scheduler.is_completed(job):
-            completed_jobs.append(job)
-        elif job_scheduler.is_broken(job):
-            broken_jobs.append(job)
-
-    print ("      # of jobs in total = % 3d" % len(jobs))
-    print ("                 waiting = % 3d    {%s}" %
-           (len(waiting_jobs), _format_ids(waiting_jobs)))
-    print ("                 running = % 3d    {%s}" %
-           (len(running_jobs), _format_ids(running_jobs)))
-    print ("               completed = % 3d    {%s}" %
-           (len(completed_jobs), _format_ids(completed_jobs)))
-    print ("                  broken = % 3d    {%s}" %
-           (len(broken_jobs), _format_ids(broken_jobs)))
+def _format_experiment(experiment):
+    lines = ["Name: %s" % bold(experiment["name"]),
+             "  Id: %d" % experiment["jobman"]["id"]]
+    for key in ["table", "gpu"]:
+        lines.append("      %s = %s" % (key, str(experiment[key])))
+
+    for name, cluster in experiment["clusters"].iteritems():
+        lines.append("      %s:" % name)
+        for key, value in sorted(cluster.iteritems()):
+            lines.append("          %s = %s" % (key, value))
+
+    return lines
+
+
+def list_jobs(table_name, show_maximum=20):
+    jobs_count = job_scheduler.count_jobs(table_name, sample_size=show_maximum)
+
+    print "\n".join(_format_jobs_count(jobs_count, show_maximum))
+
+
+def _format_jobs_count(jobs_count, show_maximum=20):
+
+    def format_count(name):
+        count, ids = jobs_count[name]
+        return count, _format_ids(ids, count, show_maximum)
+
+    return [
+        "      # of jobs in total = % 3d" % jobs_count["total"][0],
+        "                 waiting = % 3d    {%s}" % format_count("pending"),
+        "                 running = % 3d    {%s}" % format_count("running"),
+        "               completed = % 3d    {%s}" % format_count("completed"),
+        "                  broken = % 3d    {%s}" % format_count("broken")]
+
+
+def watch_experiments(cluster, interval=10, show_maximum=20):
+    """Redraw the output of list in place every interval seconds
+
+    Statuses of jobs are kept in memory and each poll only fetches
+    experiments and jobs changed since the previous one, see
+    schedulers.jobs.JobsWatch. Stops on Ctrl-C.
+    """
+    experiments_watch = job_scheduler.JobsWatch("experiments")
+    jobs_watches = dict()
+    experiments = None
+
+    try:
+        while True:
+            start_time = time.time()
+
+            # Any update of an experiment is redrawn, e.g. of its clusters
+            if experiments_watch.poll() > 0 or experiments is None:
+                experiments = experiment_scheduler.load_experiments(
+                    cluster, cache=False)
+                tables = set(experiment["table"] for experiment in experiments)
+                for table_name in set(jobs_watches) - tables:
+                    del jobs_watches[table_name]
+
+            lines = []
+            if len(experiments) == 0:
+                lines.append("No experiments in database %s" %
+                             get_db_string("experiments"))
+
+            for experiment in experiments:
+                table_name = experiment["table"]
+                if table_name not in jobs_watches:
+                    jobs_watches[table_name] = job_scheduler.JobsWatch(
+                        table_name)
+                jobs_watches[table_name].poll()
+
+                lines += _format_experiment(experiment)
+                lines += _format_jobs_count(
+                    jobs_watches[table_name].count(show_maximum),
+                    show_maximum)
+                lines.append("")
+
+            lines.append("Every %gs, updated at %s" %
+                         (interval, time.strftime("%H:%M:%S")))
+            _redraw(lines)
+
+            time.sleep(max(0, interval - (time.time() - start_time)))
+    except KeyboardInterrupt:
+        pass
+
+
+def _redraw(lines):
+    """Draw lines over the previous ones on terminals"""
+    if not sys.stdout.isatty():
+        print "\n".join(lines) + "\n"
+        return
+
+    # Cursor to the top left, clear the end of each line and of the screen
+    sys.stdout.write("\033[H" + "".join("%s\033[K\n" % line
+                                         for line in lines) + "\033[J")
+    sys.stdout.flush()
 
 
 def monitor(cluster):
@@ -184,20 +353,40 @@ def monitor(cluster):
         print "No experiments in database %s" % get_db_string("experiments")
         return
 
+    snapshot = observer.ClusterSnapshot()
+
     for experiment in experiments:
-        nb_of_jobs_to_launch = monitor_single_experiment(cluster, experiment)
+        nb_of_jobs_to_launch = monitor_single_experiment(cluster, experiment,
+                                                         snapshot)
+        snapshot.record_submission(nb_of_jobs_to_launch)
 
         print "would submit %d new jobs\n" % nb_of_jobs_to_launch
 
 
-def monitor_single_experiment(cluster, experiment):
-    username = pwd.getpwuid(os.getuid()).pw_name
+def monitor_single_experiment(cluster, experiment, snapshot=None):
+    """Compute the number of jobs to submit for an experiment
+
+    If the experiment packs jobs on the cluster, the number of allocations
+    needed to run pending jobs `pack` at a time is returned instead.
+    Submitted jobs are counted from snapshot, an observer.ClusterSnapshot
+    shared by all experiments of a cycle, or from a new one if None.
+    """
+    if snapshot is None:
+        snapshot = observer.ClusterSnapshot()
+
+    username = observer.get_username()
 
     print "Verifying jobs for experiment \"%s\"" % experiment["name"]
     nb_of_waiting_jobs = observer.count_pending_jobs(experiment["table"])
-    nb_of_user_submitted_jobs = observer.count_submitted_jobs(username)
+    nb_of_user_submitted_jobs = snapshot.count_submitted_jobs(username)
 
     print "%d jobs waiting" % nb_of_waiting_jobs
+
+    # Allocations are counted, a packed one runs `pack` jobs at once
+    pack = experiment["clusters"][cluster].get("pack", 1)
+    if pack > 1:
+        nb_of_waiting_jobs = (nb_of_waiting_jobs + pack - 1) // pack
+        print "%d packed slots of %d jobs needed" % (nb_of_waiting_jobs, pack)
     print ("%d jobs submitted (from all experiments)" %
            nb_of_user_submitted_jobs)
 
@@ -207,7 +396,7 @@ def monitor_single_experiment(cluster, experiment):
     nb_of_jobs_to_launch = min(nb_of_waiting_jobs, max_queued_jobs)
 
     if experiment["clusters"][cluster]["max_queued"] > 0:
-        nb_of_total_submitted_jobs = observer.count_submitted_jobs()
+        nb_of_total_submitted_jobs = snapshot.count_submitted_jobs()
         still_free = (experiment["clusters"][cluster]["max_queued"] -
                       nb_of_total_submitted_jobs)
         print "%s cores are free" % still_free
@@ -216,7 +405,8 @@ def monitor_single_experiment(cluster, experiment):
     return nb_of_jobs_to_launch
 
 
-def launch(cluster, limit, experiment):
+def launch(cluster, limit, experiment, snapshot=None, deadline=None,
+           workers=False):
     if cluster is None:
         raise ValueError("cluster must be specified for launch option")
 
@@ -234,20 +424,190 @@ def launch(cluster, limit, experiment):
         print "No experiments in database %s" % get_db_string("experiments")
         return
 
+    if snapshot is None:
+        snapshot = observer.ClusterSnapshot()
+
+    planning_start_time = time.time()
+    submissions = []
     for experiment in experiments:
-        nb_of_jobs_to_launch = monitor_single_experiment(cluster, experiment)
+        if deadline is not None and time.time() > deadline:
+            print "deadline reached, remaining experiments are skipped"
+            break
+
+        nb_of_jobs_to_launch = monitor_single_experiment(cluster, experiment,
+                                                         snapshot)
 
         if nb_of_jobs_to_launch > 0:
             if limit and nb_of_jobs_to_launch > limit:
                 print "would submit %d new jobs" % nb_of_jobs_to_launch
                 nb_of_jobs_to_launch = limit
             print "submitting %d new jobs" % nb_of_jobs_to_launch
-            job_scheduler.submit_job(cluster, experiment, nb_of_jobs_to_launch)
+            submissions.append((experiment, nb_of_jobs_to_launch))
+            # Next experiments must account for these jobs
+            snapshot.record_submission(nb_of_jobs_to_launch)
         else:
             print "no job to launch"
 
         print "\n"
-        time.sleep(15)
+
+    metrics.observe("launch_phase_seconds",
+                    time.time() - planning_start_time, phase="plan")
+
+    with metrics.time_block("launch_phase_seconds", phase="submit"):
+        submit_jobs(cluster, submissions, deadline, workers)
+
+
+def submit_jobs(cluster, submissions, deadline=None, workers=False):
+    """Submit (experiment, nb_of_jobs_to_launch) pairs concurrently
+
+    If workers is True, each submitted job is a worker running pending jobs
+    of its experiment until none is left (see worker).
+
+    jobdispatch processes run in the background, at most `workers` of them
+    at once, and are rate limited by a token bucket, all configured in the
+    launch section of ~/.distributed_jobman.rc. Submissions not started by
+    the deadline (a time.time() value) are dropped.
+    """
+    if len(submissions) == 0:
+        return
+
+    rate_limiter = TokenBucket(config["launch"]["rate"],
+                               config["launch"]["burst"])
+
+    running = []
+
+    def wait(experiment, process):
+        result = process.wait()
+        sys.stdout.write(result.stdout + "\n")
+        sys.stdout.write(result.stderr + "\n")
+        if not result.success:
+            logger.error("Submission failed for experiment %s: %s" %
+                         (experiment["name"], str(ProcessError(result))))
+
+    for experiment, nb_of_jobs_to_launch in submissions:
+        if len(running) >= config["launch"]["workers"]:
+            wait(*running.pop(0))
+
+        rate_limiter.acquire()
+        if deadline is not None and time.time() > deadline:
+            logger.warning("Deadline reached, submission for experiment %s "
+                           "is dropped" % experiment["name"])
+            continue
+
+        try:
+            running.append((experiment, job_scheduler.start_job_submission(
+                cluster, experiment, nb_of_jobs_to_launch, workers)))
+        except OSError as e:
+            logger.error("Submission failed for experiment %s: %s" %
+                         (experiment["name"], str(e)))
+
+    for experiment, process in running:
+        wait(experiment, process)
+
+
+def reap(cluster, experiment, timeout=None):
+    """Set running jobs with a stale heartbeat back to pending"""
+    if experiment:
+        filter_eq_dct = dict(name=experiment)
+    else:
+        filter_eq_dct = None
+
+    experiments = experiment_scheduler.load_experiments(
+        cluster, filter_eq_dct=filter_eq_dct)
+
+    if len(experiments) == 0:
+        print "No experiments in database %s" % get_db_string("experiments")
+        return
+
+    for experiment in experiments:
+        ids = job_scheduler.reap_jobs(experiment["table"], timeout)
+        print "%d stale jobs reset for experiment \"%s\" {%s}" % (
+            len(ids), experiment["name"], _format_ids(ids, len(ids)))
+
+
+def rebuild(cluster, experiment):
+    """Rebuild status tables of job tables from their key/value pairs"""
+    if experiment:
+        filter_eq_dct = dict(name=experiment)
+    else:
+        filter_eq_dct = None
+
+    experiments = experiment_scheduler.load_experiments(
+        cluster, filter_eq_dct=filter_eq_dct)
+
+    if len(experiments) == 0:
+        print "No experiments in database %s" % get_db_string("experiments")
+        return
+
+    for experiment in experiments:
+        nb_of_jobs = job_scheduler.rebuild_status(experiment["table"])
+        print "Status of %d jobs rebuilt for experiment \"%s\"" % (
+            nb_of_jobs, experiment["name"])
+
+
+def daemon(cluster, limit, experiment, interval, deadline=None,
+           workers=False, reap_jobs=False):
+    """Run launch cycles every `interval` seconds until SIGTERM or SIGINT
+
+    Database connections, cached experiments, the GPU sampler and the
+    cluster snapshot object are kept from one cycle to the next. A cycle
+    stops submitting jobs `deadline` seconds after its start (the interval
+    by default), the current cycle is completed before stopping. If
+    reap_jobs is True, stale running jobs are set back to pending at the
+    start of each cycle.
+    """
+    if cluster is None:
+        raise ValueError("cluster must be specified for daemon option")
+
+    if deadline is None:
+        deadline = interval
+
+    stop_event = threading.Event()
+
+    def stop(signal_number, frame):
+        logger.warning("Signal %d received, stopping after current cycle" %
+                       signal_number)
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    snapshot = observer.ClusterSnapshot()
+
+    while not stop_event.is_set():
+        start_time = time.time()
+        snapshot.refresh()
+
+        try:
+            if reap_jobs:
+                reap(cluster, experiment)
+            launch(cluster, limit, experiment, snapshot=snapshot,
+                   deadline=start_time + deadline, workers=workers)
+        except SessionInterrupted:
+            logger.warning("Launch cycle interrupted")
+        except Exception:
+            logger.exception("Launch cycle failed")
+
+        cycle_time = time.time() - start_time
+        logger.info("Launch cycle done in %.2f seconds" % cycle_time)
+        metrics.observe("launch_cycle_seconds", cycle_time)
+        write_metrics()
+        # Wake up regularly, signals are not delivered while waiting
+        while (not stop_event.is_set() and
+               time.time() - start_time < interval):
+            stop_event.wait(min(1., interval - (time.time() - start_time)))
+
+
+def write_metrics():
+    """Write metrics to the Prometheus textfile set in the configuration"""
+    if not config["metrics"]["textfile"]:
+        return
+
+    try:
+        metrics.registry.write_textfile(config["metrics"]["textfile"])
+    except (IOError, OSError) as e:
+        logger.warning("Could not write metrics to %s: %s" %
+                       (config["metrics"]["textfile"], str(e)))
 
 
 function_path_re = re.compile('\.py$')
@@ -272,28 +632,188 @@ def run(function_path, experiment_config_file, job_config_file, force):
         channel = Channel()
 
         state["jobman"] = dict(status=channel.START)
-        state_to_hash = copy.copy(state)
-        jobs = job_scheduler.load_jobs(table_name, hash_of=state_to_hash)
-        state_to_hash["jobman"] = dict(status=channel.RUNNING)
-        jobs += job_scheduler.load_jobs(table_name, hash_of=state_to_hash)
+        # A pending job registered beforehand is claimed atomically
+        jobs = job_scheduler.claim_jobs(table_name, 1, hash_of=state)
         if len(jobs) > 0:
             logger.warning("Job already registered, loading from database")
             state = jobs[0]
+        else:
+            state_to_hash = copy.copy(state)
+            jobs = job_scheduler.load_jobs(table_name, hash_of=state_to_hash,
+                                           cache=False)
+            state_to_hash["jobman"] = dict(status=channel.RUNNING)
+            jobs += job_scheduler.load_jobs(table_name,
+                                            hash_of=state_to_hash,
+                                            cache=False)
+            if len(jobs) > 0:
+                logger.warning("Job already registered, loading from "
+                               "database")
+                state = jobs[0]
+
+            if state["jobman"]["status"] != channel.START:
+                if not force:
+                    raise RuntimeError("Job (%d) is not available" %
+                                       state["id"])
+
+                logging.warning("Job (%d) is not available. Forcing it to run"
+                                % state["id"])
+
+            state["jobman"]["status"] = channel.RUNNING
+
+            state = job_scheduler.save_job(table_name, state)
+
+        with job_scheduler.Heartbeat() as heartbeat:
+            heartbeat.add(table_name, state["id"])
+            heartbeat.beat()
+            resolve(function_path_re.sub('', function_path)).jobman_main(
+                state, channel)
 
-        if state["jobman"]["status"] != channel.START:
-            if not force:
-                raise RuntimeError("Job (%d) is not available" % state["id"])
+        job_scheduler.save_job(experiment["table"], state)
 
-            logging.warning("Job (%d) is not available. Forcing it to run" %
-                            state["id"])
 
-        state["jobman"]["status"] = channel.RUNNING
+def pack_workers(pack, pack_mem, *worker_args):
+    """Run `pack` workers concurrently in child processes
+
+    Workers share the resources of the allocation, e.g. a GPU. If pack_mem
+    is given, the data segment of each worker is capped to pack_mem MB.
+    Workers know their index and the pack size from environment variables
+    DISTRIBUTED_JOBMAN_PACK_INDEX and DISTRIBUTED_JOBMAN_PACK, for instance
+    to limit the GPU memory they use. SIGTERM and SIGINT are forwarded to
+    the workers. Exits with status 1 if any worker failed.
+    """
+
+    def run_packed_worker(index):
+        # Connections inherited from the parent must not be shared
+        database.close()
+        os.environ["DISTRIBUTED_JOBMAN_PACK_INDEX"] = str(index)
+        os.environ["DISTRIBUTED_JOBMAN_PACK"] = str(pack)
+        if pack_mem > 0:
+            limit = pack_mem * 2 ** 20
+            resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+        worker(*worker_args)
+
+    processes = [multiprocessing.Process(target=run_packed_worker,
+                                         args=(index, ))
+                 for index in xrange(pack)]
+    for process in processes:
+        process.start()
+
+    def stop(signal_number, frame):
+        logger.warning("Signal %d received, stopping workers" %
+                       signal_number)
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal_number)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for process in processes:
+        # Wake up regularly, signals are not delivered while joining
+        while process.is_alive():
+            process.join(1.)
+
+    failed = [index for index, process in enumerate(processes)
+              if process.exitcode != 0]
+    if len(failed) > 0:
+        logger.error("Packed workers %s failed" % str(failed))
+        # Let the scheduler know that the allocation failed
+        sys.exit(1)
+
+
+def worker(experiment_name, function_path=None, idle_timeout=60,
+           budget=None, root=".", poll_interval=5):
+    """Run pending jobs of an experiment one after the other in-process
+
+    Jobs are claimed atomically so that many workers can share the same
+    table, and their heartbeat is updated while they run (see
+    schedulers.jobs.reap_jobs). The database connection and the imported
+    main functions are reused from one job to the next. The worker stops
+    once no job was pending for `idle_timeout` seconds, when `budget`
+    seconds elapsed since its start or after SIGTERM or SIGINT, the
+    current job is completed before stopping.
+    """
+    experiments = experiment_scheduler.load_experiments(
+        cluster=None, filter_eq_dct=dict(name=experiment_name))
 
-        state = job_scheduler.save_job(table_name, state)
+    if len(experiments) == 0:
+        print "No experiments in database %s" % get_db_string("experiments")
+        return
 
-        resolve(function_path_re.sub('', function_path)).jobman_main(state, channel)
+    table_name = experiments[0]["table"]
+
+    stop_event = threading.Event()
+
+    def stop(signal_number, frame):
+        logger.warning("Signal %d received, stopping after current job" %
+                       signal_number)
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    start_time = time.time()
+    last_job_time = start_time
+    nb_of_jobs = 0
+
+    with job_scheduler.Heartbeat() as heartbeat:
+        while not stop_event.is_set():
+            if budget is not None and time.time() - start_time > budget:
+                logger.info("Time budget exhausted")
+                break
+
+            try:
+                jobs = job_scheduler.claim_jobs(table_name, 1)
+            except SessionInterrupted:
+                # The claim is rolled back and stop was already called
+                continue
+
+            if len(jobs) == 0:
+                if time.time() - last_job_time > idle_timeout:
+                    logger.info("No pending job for %d seconds" %
+                                idle_timeout)
+                    break
+                stop_event.wait(poll_interval)
+                continue
+
+            job_id = jobs[0]["id"]
+            heartbeat.add(table_name, job_id)
+            try:
+                _run_job(table_name, jobs[0], function_path, root)
+            finally:
+                heartbeat.remove(table_name, job_id)
+            nb_of_jobs += 1
+            last_job_time = time.time()
+
+    print "%d jobs run in %.2f seconds" % (nb_of_jobs,
+                                          time.time() - start_time)
+
+
+def _run_job(table_name, state, function_path=None, root="."):
+    """Run a claimed job, its final status is saved back in the database"""
+    channel = Channel()
+
+    try:
+        # Modules are only imported once per worker, resolve relies on
+        # sys.modules
+        if function_path is None:
+            function = resolve(state["jobman"]["experiment"])
+        else:
+            function = resolve(
+                function_path_re.sub('', function_path)).jobman_main
+
+        with ChangeDir(os.path.join(root, table_name, str(state["id"]))):
+            result = function(state, channel)
+    except Exception:
+        logger.exception("Job (%d) failed" % state["id"])
+        state["jobman"]["status"] = sql.ERR_RUN
+    else:
+        if result == channel.INCOMPLETE:
+            state["jobman"]["status"] = sql.START
+        else:
+            state["jobman"]["status"] = sql.DONE
 
-        job_scheduler.save_job(experiment["table"], state)
+    job_scheduler.save_job(table_name, state)
 
 
 def set_jobs(name, status, new_status):
@@ -306,15 +826,6 @@ def set_jobs(name, status, new_status):
 
     experiment = experiments[0]
 
-    if status == "pending":
-        jobs = job_scheduler.load_pending_jobs(experiment["table"])
-    elif status == "broken":
-        jobs = job_scheduler.load_broken_jobs(experiment["table"])
-    elif status == "completed":
-        jobs = job_scheduler.load_completed_jobs(experiment["table"])
-    elif status == "running":
-        jobs = job_scheduler.load_running_jobs(experiment["table"])
-
     if new_status == "pending":
         sql_new_status = sql.START
         new_status = "pending"
@@ -323,10 +834,20 @@ def set_jobs(name, status, new_status):
     elif new_status == "completed":
         sql_new_status = sql.COMPLETE
 
+    def progress(nb_of_processed_jobs, nb_of_jobs):
+        sys.stdout.write("\r%d/%d jobs" % (nb_of_processed_jobs, nb_of_jobs))
+        sys.stdout.flush()
+
     print "Setting %s jobs to %s status..." % (status, new_status)
-    job_scheduler.update_jobs(experiment["table"], jobs,
-                              expand({sql.STATUS: sql_new_status,
-                                      'proc_status': new_status}))
+    nb_of_updated_jobs, failed_ids = job_scheduler.set_jobs(
+        experiment["table"], status,
+        expand({sql.STATUS: sql_new_status, 'proc_status': new_status}),
+        progress=progress)
+    print
+    print "%d jobs updated" % nb_of_updated_jobs
+    if len(failed_ids) > 0:
+        print "%d jobs failed {%s}" % (len(failed_ids),
+                                       _format_ids(failed_ids, len(failed_ids)))
 
 
 def reset_jobs(name, status):
@@ -343,17 +864,56 @@ def remove_experiment(name):
 
     experiment = experiments[0]
     table_name = experiment["table"]
-    if query_yes_no("Do you really want to delete experiment %s?" % bold(name)):
+    delete_experiment = query_yes_no(
+        "Do you really want to delete experiment %s?" % bold(name))
+    delete_jobs = query_yes_no("Do you want to delete corresponding jobs?")
+
+    # Jobs are deleted first so that an interrupted removal can be resumed
+    # by running the command again
+    if delete_jobs:
+        nb_of_jobs = job_scheduler.count_jobs(table_name)["total"][0]
+        print "Deleting %d jobs..." % nb_of_jobs
+
+        def progress(nb_of_processed_jobs, nb_of_jobs):
+            sys.stdout.write("\r%d/%d jobs" %
+                             (nb_of_processed_jobs, nb_of_jobs))
+            sys.stdout.flush()
+
+        nb_of_deleted_jobs, failed_ids = job_scheduler.delete_all_jobs(
+            table_name, progress=progress)
+        print
+        if len(failed_ids) > 0:
+            print ("%d jobs could not be deleted {%s}, run the command again "
+                   "to complete the removal" %
+                   (len(failed_ids), _format_ids(failed_ids, len(failed_ids))))
+            return
+    if delete_experiment:
         print "Deleting %s..." % name
         experiment_scheduler.delete_experiments([experiment])
-    if query_yes_no("Do you want to delete corresponding jobs?"):
-        jobs = job_scheduler.load_jobs(table_name)
-        print "Deleting %d jobs..." % len(jobs)
-        job_scheduler.delete_jobs(table_name, jobs)
     # if query_yes_no("Do you want to delete corresponding files?"):
     #    pass
 
 
+def print_job_ids(name, status=None, limit=None, last=False):
+    """Print ids of jobs one per line, only fetching the ones printed"""
+    experiments = experiment_scheduler.load_experiments(
+        cluster=None, filter_eq_dct=dict(name=name))
+
+    if len(experiments) == 0:
+        print "No experiments in database %s" % get_db_string("experiments")
+        return
+
+    if status is None:
+        filter_eq_dct = None
+    else:
+        filter_eq_dct = {sql.STATUS: job_scheduler.STATUSES[status]}
+
+    for job_id in job_scheduler.load_job_ids(
+            experiments[0]["table"], filter_eq_dct,
+            order_by="-id" if last else "id", limit=limit):
+        print job_id
+
+
 def plot_experiment(experiment_name):
     experiments = experiment_scheduler.load_experiments(
         cluster=None, filter_eq_dct=dict(name=experiment_name))
@@ -376,21 +936,52 @@ def main(argv):
         logging.basicConfig(level=logging.WARNING, format=LOGGING_FORMAT)
 
     if options.command == LAUNCH:
-        launch(options.cluster, options.limit, options.experiment)
+        launch(options.cluster, options.limit, options.experiment,
+               workers=options.workers)
     if options.command == RUN:
         run(options.main_function_path, options.experiment_config,
             options.job_config, options.force)
     elif options.command == MONITOR:
         monitor(options.cluster)
+    elif options.command == LIST and options.watch:
+        watch_experiments(options.cluster, options.interval)
     elif options.command == LIST:
         list_experiments(options.cluster)
+    elif options.command == SET:
+        set_jobs(options.experiment_name, options.job_status,
+                 options.new_status)
     elif options.command == RESET:
         reset_jobs(options.experiment_name,
                    options.job_status)
     elif options.command == REMOVE:
         remove_experiment(options.name)
+    elif options.command == IDS:
+        print_job_ids(options.experiment_name, options.job_status,
+                      options.number, options.last)
     elif options.command == PLOT:
         plot_experiment(options.experiment_name)
+    elif options.command == DAEMON:
+        daemon(options.cluster, options.limit, options.experiment,
+               options.interval, options.deadline, options.workers,
+               options.reap)
+    elif (options.command == WORKER and
+          (options.pack > 1 or options.pack_mem > 0)):
+        pack_workers(options.pack, options.pack_mem, options.experiment_name,
+                     options.function, options.idle_timeout, options.budget,
+                     options.root)
+    elif options.command == WORKER:
+        worker(options.experiment_name, options.function,
+               options.idle_timeout, options.budget, options.root)
+    elif options.command == REAP:
+        reap(options.cluster, options.experiment, options.timeout)
+    elif options.command == REBUILD:
+        rebuild(options.cluster, options.experiment)
+
+    logger.debug("Database cache statistics: %s" % str(database.cache.stats()))
+
+    write_metrics()
+    if options.stats:
+        print metrics.registry.format_summary()
 
 
 if __name__ == "__main__":
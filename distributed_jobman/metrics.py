@@ -0,0 +1,184 @@
+from collections import OrderedDict
+import contextlib
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Upper bounds in seconds of latency histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1., 5., 10., 30., 60., 300.)
+
+PREFIX = "distributed_jobman_"
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        for index, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.bucket_counts[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def summary(self):
+        return OrderedDict([
+            ("count", self.count), ("sum", self.sum),
+            ("mean", self.sum / self.count if self.count else 0.),
+            ("min", self.min), ("max", self.max)])
+
+
+class Registry(object):
+    """Counters and latency histograms identified by name and labels
+
+    Labels are given as keyword arguments, e.g. table and command. All
+    methods are thread-safe.
+    """
+
+    def __init__(self):
+        self._counters = dict()
+        self._histograms = dict()
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(seconds)
+
+    @contextlib.contextmanager
+    def time(self, name, **labels):
+        """Observe the duration of the with block, even if it raises"""
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start_time, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def summary(self):
+        """Return a dict of all metrics, ready for json.dumps"""
+        summary = dict()
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.iteritems()):
+                summary.setdefault(name, []).append(
+                    OrderedDict([("labels", dict(labels)), ("value", value)]))
+            for (name, labels), histogram in sorted(
+                    self._histograms.iteritems()):
+                entry = OrderedDict([("labels", dict(labels))])
+                entry.update(histogram.summary())
+                summary.setdefault(name, []).append(entry)
+
+        return summary
+
+    def format_textfile(self):
+        """Format metrics in Prometheus' text exposition format"""
+        lines = []
+        with self._lock:
+            counter_names = sorted(set(
+                name for name, labels in self._counters))
+            for name in counter_names:
+                lines.append("# TYPE %s%s counter" % (PREFIX, name))
+                for (other_name, labels), value in sorted(
+                        self._counters.iteritems()):
+                    if other_name == name:
+                        lines.append("%s%s%s %s" % (
+                            PREFIX, name, _format_labels(labels), value))
+
+            histogram_names = sorted(set(
+                name for name, labels in self._histograms))
+            for name in histogram_names:
+                lines.append("# TYPE %s%s histogram" % (PREFIX, name))
+                for (other_name, labels), histogram in sorted(
+                        self._histograms.iteritems()):
+                    if other_name != name:
+                        continue
+                    cumulative_count = 0
+                    for upper_bound, count in zip(histogram.buckets,
+                                                  histogram.bucket_counts):
+                        cumulative_count += count
+                        lines.append("%s%s_bucket%s %d" % (
+                            PREFIX, name,
+                            _format_labels(labels + (("le", upper_bound), )),
+                            cumulative_count))
+                    lines.append("%s%s_bucket%s %d" % (
+                        PREFIX, name,
+                        _format_labels(labels + (("le", "+Inf"), )),
+                        histogram.count))
+                    lines.append("%s%s_sum%s %f" % (
+                        PREFIX, name, _format_labels(labels), histogram.sum))
+                    lines.append("%s%s_count%s %d" % (
+                        PREFIX, name, _format_labels(labels),
+                        histogram.count))
+
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, file_path):
+        """Write metrics for node_exporter's textfile collector
+
+        The file is replaced atomically so that it is never read half
+        written.
+        """
+        directory = os.path.dirname(os.path.abspath(file_path))
+        file_descriptor, tmp_path = tempfile.mkstemp(dir=directory,
+                                                     suffix=".tmp")
+        with os.fdopen(file_descriptor, "w") as f:
+            f.write(self.format_textfile())
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, file_path)
+
+    def format_summary(self):
+        return json.dumps(self.summary(), indent=4, sort_keys=True)
+
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ""
+
+    return "{%s}" % ",".join(
+        '%s="%s"' % (key, str(value).replace("\\", "\\\\")
+                     .replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels)
+
+
+registry = Registry()
+
+increment = registry.increment
+observe = registry.observe
+time_block = registry.time
+
+
+def timed(name, **labels):
+    """Decorator observing the duration of each call"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            with registry.time(name, **labels):
+                return function(*args, **kwargs)
+
+        return timed_function
+
+    return decorator
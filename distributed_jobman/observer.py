@@ -1,33 +1,39 @@
+from collections import defaultdict
+import os
+import pwd
+
 import distributed_jobman.schedulers.jobs as job_scheduler
 from distributed_jobman.parsers.qstat import qstat
 # from distributed_jobman.parsers.showq import showq
 from distributed_jobman import config
 
-try:
-    import nvidia
-except ImportError:
-    nvidia = None
+from distributed_jobman.parsers import nvidia
+
+
+def count_jobs(table_name):
+    return dict((name, count) for name, (count, ids)
+                in job_scheduler.count_jobs(table_name).iteritems())
 
 
 def count_pending_jobs(table_name):
-    return len(job_scheduler.load_pending_jobs(table_name))
+    return count_jobs(table_name)["pending"]
 
 
 def count_running_jobs(table_name):
-    return len(job_scheduler.load_running_jobs(table_name))
+    return count_jobs(table_name)["running"]
 
 
 def count_completed_jobs(table_name):
-    return len(job_scheduler.load_completed_jobs(table_name))
+    return count_jobs(table_name)["completed"]
 
 
 def count_broken_jobs(table_name):
-    return len(job_scheduler.load_broken_jobs(table_name))
+    return count_jobs(table_name)["broken"]
 
 
 def count_submitted_jobs(username=None):
     if config["scheduler"]["type"] == "multi-gpu":
-        if nvidia is None:
+        if nvidia.pynvml is None:
             raise ImportError("pynvml is not installed")
         return sum(not free for free in nvidia.get_free_gpus().values())
     elif config["scheduler"]["type"] == "cluster":
@@ -35,3 +41,62 @@ def count_submitted_jobs(username=None):
         return sum(job['job_array_running'] for job in jobs)
         # jobs = showq(username)
         # return sum(len(job_array_ids) for job_array_ids in jobs.values())
+
+
+def get_username():
+    return pwd.getpwuid(os.getuid()).pw_name
+
+
+class ClusterSnapshot(object):
+    """Jobs submitted to the scheduler, captured once per launch cycle
+
+    The scheduler is queried once, on first use, for the jobs of all users.
+    Jobs submitted during the cycle are then added with record_submission()
+    so that counts stay accurate without querying the scheduler again.
+    refresh() drops the capture, the next count queries the scheduler.
+    """
+
+    def __init__(self):
+        self._user_counts = None
+        self._total_count = None
+
+    def refresh(self):
+        self._user_counts = None
+        self._total_count = None
+
+    def capture(self):
+        self._user_counts = defaultdict(int)
+        self._total_count = 0
+
+        if config["scheduler"]["type"] == "multi-gpu":
+            if nvidia.pynvml is None:
+                raise ImportError("pynvml is not installed")
+            self._total_count = sum(
+                not free for free in nvidia.get_free_gpus().values())
+        elif config["scheduler"]["type"] == "cluster":
+            for job in qstat():
+                username = job.get("Job_Owner", "").split("@")[0]
+                self._user_counts[username] += job['job_array_running']
+                self._total_count += job['job_array_running']
+
+    def count_submitted_jobs(self, username=None):
+        """Count jobs submitted by username, or by everyone if None"""
+        if self._user_counts is None:
+            self.capture()
+
+        # GPUs of a workstation are not attributed to users
+        if username is None or config["scheduler"]["type"] == "multi-gpu":
+            return self._total_count
+
+        return self._user_counts[username]
+
+    def record_submission(self, nb_of_jobs, username=None):
+        """Account for jobs submitted since the capture"""
+        if username is None:
+            username = get_username()
+
+        if self._user_counts is None:
+            self.capture()
+
+        self._user_counts[username] += nb_of_jobs
+        self._total_count += nb_of_jobs
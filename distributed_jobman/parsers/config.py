@@ -1,29 +1,95 @@
 from ConfigParser import ConfigParser, Error
 import os
 
-p2_config = ConfigParser()
+default_values = dict(cache_timeout=str(60 * 5),
+                      cache_bytes=str(64 * 1024 * 1024), pool_size="5",
+                      max_overflow="10", pool_recycle=str(60 * 60),
+                      pool_timeout="30", single_connection="false",
+                      qstat_format="xml", rate="0.5", burst="5", workers="4",
+                      heartbeat_interval="60", stale_timeout=str(60 * 10),
+                      timeout="60", submit_timeout=str(60 * 5), textfile="",
+                      backend="postgres",
+                      path=os.path.join(os.environ["HOME"],
+                                        ".distributed_jobman.sqlite"),
+                      busy_timeout="30")
+
+p2_config = ConfigParser(default_values)
 p2_config.read(os.path.join(os.environ["HOME"], ".distributed_jobman.rc"))
 
-default_values = dict(cache_timeout=str(60 * 5))
+backends = ["postgres", "sqlite"]
+
+# Credentials are only needed by postgres
+credential_keys = ["username", "password", "address", "name"]
+
+keys = ["backend", "path", "busy_timeout", "cache_timeout", "cache_bytes",
+        "pool_size", "max_overflow", "pool_recycle", "pool_timeout"]
 
-keys = ["username", "password", "address", "name", "cache_timeout"]
+# A sqlite database can be used without any database section
+if not p2_config.has_section("database"):
+    p2_config.add_section("database")
 
 database = dict()
 for key in keys:
-    value = p2_config.get("database", key, vars=default_values)
+    database[key] = p2_config.get("database", key)
 
-    if value is None:
+if database["backend"] not in backends:
+    raise Error("Invalid database backend: %s" % database["backend"])
+
+for key in credential_keys:
+    if p2_config.has_option("database", key):
+        database[key] = p2_config.get("database", key)
+    elif database["backend"] == "postgres":
         raise ValueError("Option %s must be set in configuration file "
-                         "~/.distributed_jobman.rc")
-    database[key] = value
+                         "~/.distributed_jobman.rc" % key)
+    else:
+        database[key] = None
 
+database["path"] = os.path.abspath(os.path.expanduser(database["path"]))
+database["busy_timeout"] = float(database["busy_timeout"])
 database["cache_timeout"] = float(database["cache_timeout"])
+for key in ["cache_bytes", "pool_size", "max_overflow", "pool_recycle", "pool_timeout"]:
+    database[key] = int(database[key])
+database["single_connection"] = p2_config.getboolean("database",
+                                                     "single_connection")
 
 scheduler_types = ["multi-gpu", "cluster"]
 
-scheduler = dict(type=p2_config.get("scheduler", "type"))
+qstat_formats = ["xml", "text"]
+
+scheduler = dict(type=p2_config.get("scheduler", "type"),
+                 qstat_format=p2_config.get("scheduler", "qstat_format"),
+                 timeout=float(p2_config.get("scheduler", "timeout")))
 
 if scheduler["type"] not in scheduler_types:
     raise Error("Invalid scheduler type: %s" % scheduler["type"])
 
-config = dict(database=database, scheduler=scheduler)
+if scheduler["qstat_format"] not in qstat_formats:
+    raise Error("Invalid qstat format: %s" % scheduler["qstat_format"])
+
+launch = dict()
+for key, cast in [("rate", float), ("burst", int), ("workers", int),
+                  ("submit_timeout", float)]:
+    if p2_config.has_section("launch"):
+        launch[key] = cast(p2_config.get("launch", key))
+    else:
+        launch[key] = cast(default_values[key])
+
+# Submissions are taken one token at a time from a bucket of burst tokens
+if launch["burst"] < 1:
+    raise Error("Invalid launch burst: %d, it must be at least 1" %
+                launch["burst"])
+
+worker = dict()
+for key, cast in [("heartbeat_interval", float), ("stale_timeout", float)]:
+    if p2_config.has_section("worker"):
+        worker[key] = cast(p2_config.get("worker", key))
+    else:
+        worker[key] = cast(default_values[key])
+
+# Prometheus textfile where metrics are written, none if empty
+metrics = dict(textfile=default_values["textfile"])
+if p2_config.has_section("metrics"):
+    metrics["textfile"] = p2_config.get("metrics", "textfile")
+
+config = dict(database=database, scheduler=scheduler, launch=launch,
+              worker=worker, metrics=metrics)
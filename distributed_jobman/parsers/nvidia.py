@@ -1,46 +1,152 @@
-from collections import defaultdict
+from collections import deque
+import atexit
+import logging
+import threading
 import time
 
-from pynvml import (
-    nvmlInit,
-    nvmlDeviceGetCount,
-    nvmlDeviceGetHandleByIndex,
-    nvmlDeviceGetName,
-    nvmlDeviceGetTemperature,
-    nvmlShutdown)
+from distributed_jobman import metrics
+
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
+
+
+logger = logging.getLogger("nvidia")
+
+# A GPU is free if, over the sampling window, it never exceeded these
+MAX_UTILIZATION = 10  # %
+MAX_MEMORY_USED = 256 * 1024 ** 2  # bytes
 
 
 def count_gpus():
-    nvmlInit()
-    count = nvmlDeviceGetCount()
-    nvmlShutdown()
+    pynvml.nvmlInit()
+    count = pynvml.nvmlDeviceGetCount()
+    pynvml.nvmlShutdown()
     return count
 
 
 def get_gpu_temperatures():
-    nvmlInit()
+    pynvml.nvmlInit()
     gpus = dict()
-    for i in range(nvmlDeviceGetCount()):
-        handle = nvmlDeviceGetHandleByIndex(i)
-        gpus[i] = int(nvmlDeviceGetTemperature(handle, 0))
+    for i in range(pynvml.nvmlDeviceGetCount()):
+        handle = pynvml.nvmlDeviceGetHandleByIndex(i)
+        gpus[i] = int(pynvml.nvmlDeviceGetTemperature(handle, 0))
 
-    nvmlShutdown()
+    pynvml.nvmlShutdown()
     return gpus
 
 
-def get_free_gpus():
-    free_gpus = defaultdict(int)
+class GpuSampler(object):
+    """Sample GPU usage in a background thread with one NVML session
+
+    Every `interval` seconds the utilization (%), memory used (bytes) and
+    number of compute processes of each GPU are recorded. The last
+    `window_size` samples are kept in a ring buffer from which availability
+    is answered without waiting. nvml is the NVML binding to use, pynvml by
+    default.
+    """
+
+    def __init__(self, interval=1., window_size=10, nvml=None):
+        if nvml is None:
+            nvml = pynvml
+        if nvml is None:
+            raise ImportError("pynvml is not installed")
+
+        self.nvml = nvml
+        self.interval = interval
+        self.samples = deque(maxlen=window_size)
+
+        self._handles = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.nvml.nvmlInit()
+        self._handles = [self.nvml.nvmlDeviceGetHandleByIndex(i)
+                         for i in range(self.nvml.nvmlDeviceGetCount())]
+
+        # First sample is taken right away so that queries never wait
+        self.sample()
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+        self.nvml.nvmlShutdown()
 
-    for i in range(10):
-        for gpu_id, temperature in get_gpu_temperatures().iteritems():
-            free_gpus[gpu_id] = max(free_gpus[gpu_id], temperature)
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as e:
+                logger.warning("Could not sample GPUs: %s" % str(e))
 
-        time.sleep(1)
+    @metrics.timed("probe_seconds", command="nvidia")
+    def sample(self):
+        gpus = dict()
+        for i, handle in enumerate(self._handles):
+            gpus[i] = dict(
+                utilization=self.nvml.nvmlDeviceGetUtilizationRates(
+                    handle).gpu,
+                memory_used=self.nvml.nvmlDeviceGetMemoryInfo(handle).used,
+                processes=len(
+                    self.nvml.nvmlDeviceGetComputeRunningProcesses(handle)))
 
-    for gpu_id, temperature in free_gpus.iteritems():
-        free_gpus[gpu_id] = temperature < 70
+        with self._lock:
+            self.samples.append((time.time(), gpus))
 
-    return dict(free_gpus)
+    def get_free_gpus(self, max_utilization=MAX_UTILIZATION,
+                      max_memory_used=MAX_MEMORY_USED, window=None):
+        """Tell for each GPU if it was free during the last `window` seconds
+
+        A GPU is free if it ran no compute process and stayed under given
+        utilization and memory thresholds. All buffered samples are used if
+        window is None.
+        """
+        with self._lock:
+            samples = list(self.samples)
+
+        if window is not None:
+            samples = [(sample_time, gpus) for sample_time, gpus in samples
+                       if sample_time >= time.time() - window]
+
+        free_gpus = dict((i, True) for i in range(len(self._handles)))
+        for sample_time, gpus in samples:
+            for i, gpu in gpus.iteritems():
+                free_gpus[i] &= (gpu["processes"] == 0 and
+                                 gpu["utilization"] <= max_utilization and
+                                 gpu["memory_used"] <= max_memory_used)
+
+        return free_gpus
+
+
+_sampler = None
+
+
+def get_sampler():
+    """Sampler shared by the process, started on first use"""
+    global _sampler
+
+    if _sampler is None:
+        _sampler = GpuSampler()
+        _sampler.start()
+        atexit.register(_sampler.stop)
+
+    return _sampler
+
+
+def get_free_gpus():
+    return get_sampler().get_free_gpus()
 
 
 if __name__ == "__main__":
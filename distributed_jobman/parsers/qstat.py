@@ -1,45 +1,31 @@
-from collections import defaultdict
+from collections import OrderedDict
 import re
-import subprocess
-import sys
+from xml.etree import cElementTree as ElementTree
 
-from distributed_jobman.utils import is_int
+from distributed_jobman import config, metrics
+from distributed_jobman.process import Process
 
 
-def qstat(username=None, job_id=None):
-    if username is None:
-        command = "qstat -f"
-    else:
-        command = "qstat -f -u %s" % username
-
-    process = subprocess.Popen([command],
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE,
-                               shell=True)
+# Only these attributes are kept from qstat's output
+QSTAT_FIELDS = ["Job_Name", "Job_Owner", "job_state", "queue"]
 
-    if process.returncode is not None and process.returncode < 0:
-        sys.stderr.write(process.stderr.read())
-        sys.exit(1)
+QSTAT_COMMANDS = {"xml": "qstat -x -t", "text": "qstat -f -t"}
 
-    full_qstat = process.stdout.read()
 
-    if username is None:
-        command = "qstat -t"
-    else:
-        command = "qstat -t -u %s" % username
-
-    process = subprocess.Popen([command],
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE,
-                               shell=True)
+def qstat(username=None, job_id=None):
+    """List jobs of the scheduler, array subjobs being grouped
 
-    if process.returncode is not None and process.returncode < 0:
-        sys.stderr.write(process.stderr.read())
-        sys.exit(1)
+    A single `qstat -t` call lists every subjob, the number of subjobs of
+    an array is given in `job_array_running`. The format of qstat's output
+    is set by qstat_format in the scheduler section of the configuration
+    file, `xml` (default, Torque's -x) or `text` (-f).
+    """
+    qstat_format = config["scheduler"]["qstat_format"]
 
-    row_qstat = process.stdout.read()
+    jobs = _run_qstat(QSTAT_COMMANDS[qstat_format], PARSERS[qstat_format])
 
-    jobs = parse_qstat(row_qstat, full_qstat)
+    if username is not None:
+        jobs = filter(lambda job: _get_username(job) == username, jobs)
 
     if job_id is not None:
         return filter(lambda job: job["id"] == job_id, jobs)
@@ -47,42 +33,98 @@ def qstat(username=None, job_id=None):
         return jobs
 
 
+def _get_username(job):
+    return job.get("Job_Owner", "").split("@")[0]
+
+
+@metrics.timed("probe_seconds", command="qstat")
+def _run_qstat(command, parse):
+    # qstat is killed if it hangs, a launch cycle then fails instead of
+    # waiting forever
+    result = Process(command.split(" "), timeout=config["scheduler"]["timeout"],
+                     parse=parse).wait()
+
+    # A failing qstat explains parse errors better than the parser, these
+    # are only raised by wait() if qstat succeeded
+    result.check()
+
+    return result.output
+
+
 id_regex = re.compile("^[0-9]*")
+array_index_regex = re.compile("\[[0-9]*\]")
 
 
-def parse_qstat(row_qstat, full_qstat):
+def _group_array_jobs(jobs):
+    """Merge subjobs of arrays, counting them in job_array_running"""
 
-    row_counts = defaultdict(int)
-    for row in filter(lambda a: a.strip(), row_qstat.split("\n")):
-        if is_int(row[0]):
-            row_counts[int(id_regex.search(row).group(0))] += 1
+    grouped_jobs = OrderedDict()
+    for job in jobs:
+        base_id = int(id_regex.search(job["id"]).group(0))
+        if base_id in grouped_jobs:
+            grouped_jobs[base_id]["job_array_running"] += 1
+        else:
+            job["id"] = array_index_regex.sub("[]", job["id"])
+            job["job_array_running"] = 1
+            grouped_jobs[base_id] = job
 
-    jobs = []
-    for job_desc in full_qstat.split("\n\n"):
-        if job_desc.strip() == "":
-            continue
+    return grouped_jobs.values()
 
-        job = dict(id=job_desc.split("\n")[0].split(":")[-1].strip())
 
-        last_key = None
+def parse_qstat_xml(stream, fields=QSTAT_FIELDS):
+    """Parse `qstat -x -t` output incrementally from a file-like object"""
+
+    def iter_jobs():
+        for event, element in ElementTree.iterparse(stream):
+            if element.tag != "Job":
+                continue
+
+            job = dict(id=element.findtext("Job_Id").strip())
+            for field in fields:
+                value = element.findtext(field)
+                if value is not None:
+                    job[field] = value.strip()
+
+            # Parsed jobs are not needed anymore
+            element.clear()
 
-        for line in job_desc.split("\n")[1:]:
+            yield job
 
-            if line[0] == "\t":
+    return _group_array_jobs(iter_jobs())
+
+
+def parse_qstat_text(stream, fields=QSTAT_FIELDS):
+    """Parse `qstat -f -t` output incrementally from a file-like object"""
+
+    fields = set(fields)
+
+    def iter_jobs():
+        job = None
+        last_key = None
+        for line in stream:
+            line = line.rstrip("\n")
+            if line.strip() == "":
+                continue
+            elif line.startswith("Job Id:"):
+                if job is not None:
+                    yield job
+                job = dict(id=line.split(":", 1)[1].strip())
+                last_key = None
+            elif line[0] == "\t":
                 if last_key is None:
                     raise ValueError("qstat stdout is not formatted correctly")
-                job[last_key] += line[1:]
+                if last_key in fields:
+                    job[last_key] += line[1:]
             else:
-                splits = line.split(" = ")
-                key = splits[0].strip()
-                value = " = ".join(splits[1:]).strip()
-                job[key] = value
+                splits = line.split(" = ", 1)
+                last_key = splits[0].strip()
+                if last_key in fields and len(splits) > 1:
+                    job[last_key] = splits[1].strip()
 
-            last_key = key
+        if job is not None:
+            yield job
 
-        job['job_array_running'] = \
-            row_counts[int(id_regex.search(job['id']).group(0))]
+    return _group_array_jobs(iter_jobs())
 
-        jobs.append(job)
 
-    return jobs
+PARSERS = {"xml": parse_qstat_xml, "text": parse_qstat_text}
@@ -1,9 +1,9 @@
 
 from collections import defaultdict
 import re
-import subprocess
-import sys
 
+from distributed_jobman import config
+from distributed_jobman.process import run_process
 from distributed_jobman.utils import is_int
 
 
@@ -13,18 +13,10 @@ def showq(username=None):
     else:
         command = "showq -u %s --blocking" % username
 
-    process = subprocess.Popen([command],
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE,
-                               shell=True)
+    result = run_process(command.split(" "),
+                         timeout=config["scheduler"]["timeout"]).check()
 
-    if process.returncode is not None and process.returncode < 0:
-        sys.stderr.write(process.stderr.read())
-        sys.exit(1)
-
-    showq = process.stdout.read()
-
-    jobs = parse_showq(showq)
+    jobs = parse_showq(result.stdout)
 
     return jobs
 
@@ -0,0 +1,196 @@
+from collections import namedtuple
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from distributed_jobman import metrics
+
+logger = logging.getLogger("process")
+
+
+class ProcessResult(namedtuple("ProcessResult", [
+        "command", "returncode", "stdout", "stderr", "duration",
+        "timed_out", "output"])):
+    """Outcome of a command run by Process
+
+    stdout and stderr hold the captured text, stdout is None when it was
+    consumed by a parser whose result is given in output. returncode is
+    negative if the process was killed by a signal, which is the case when
+    it timed out.
+    """
+
+    @property
+    def success(self):
+        return self.returncode == 0 and not self.timed_out
+
+    def check(self):
+        """Raise ProcessError unless the command succeeded, return self"""
+        if not self.success:
+            raise ProcessError(self)
+
+        return self
+
+
+class ProcessError(RuntimeError):
+
+    def __init__(self, result):
+        if result.timed_out:
+            reason = "timed out after %.2f seconds" % result.duration
+        else:
+            reason = "failed with exit status %d" % result.returncode
+
+        super(ProcessError, self).__init__(
+            "%s %s: %s" % (_format_command(result.command), reason,
+                           result.stderr.strip()))
+        self.result = result
+
+
+def _format_command(command):
+    if isinstance(command, basestring):
+        return command
+
+    return " ".join(command)
+
+
+def _command_name(command):
+    if isinstance(command, basestring):
+        command = command.split()
+
+    return os.path.basename(command[0])
+
+
+class Process(object):
+    """Run a command in the background, capturing both pipes as they stream
+
+    The command is started on creation, strings are run through the shell
+    and lists are executed directly. stdout and stderr are read by
+    separate threads so that neither pipe can fill up and block the
+    command. If parse is given, it is called with the stdout pipe and its
+    result is given as `output` of the ProcessResult. The command runs in
+    its own process group, which is killed after `timeout` seconds if it
+    is still running, children of the shell included.
+    """
+
+    def __init__(self, command, timeout=None, parse=None):
+        self.command = command
+        self.timeout = timeout
+        self.parse = parse
+
+        self._stdout = []
+        self._stderr = []
+        self._output = None
+        self._parse_error = None
+        self._timed_out = threading.Event()
+        self._result = None
+
+        self.start_time = time.time()
+        self.process = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            shell=isinstance(command, basestring), preexec_fn=os.setsid)
+
+        if parse is None:
+            stdout_target = self._read_stdout
+        else:
+            stdout_target = lambda: self._parse_stdout(parse)
+
+        self._threads = [
+            threading.Thread(target=stdout_target),
+            threading.Thread(target=self._read_pipe,
+                             args=(self.process.stderr, self._stderr))]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+        self._timer = None
+        if timeout is not None:
+            self._timer = threading.Timer(timeout, self._kill)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _read_pipe(self, pipe, lines):
+        for line in iter(pipe.readline, b""):
+            lines.append(line)
+        pipe.close()
+
+    def _read_stdout(self):
+        self._read_pipe(self.process.stdout, self._stdout)
+
+    def _parse_stdout(self, parse):
+        try:
+            self._output = parse(self.process.stdout)
+        except Exception:
+            self._parse_error = sys.exc_info()
+        finally:
+            # Unparsed output must still be drained for the command to end
+            for line in iter(self.process.stdout.readline, b""):
+                pass
+            self.process.stdout.close()
+
+    def _kill(self):
+        if self.process.poll() is None:
+            logger.warning("%s timed out after %s seconds, killing it" %
+                           (_format_command(self.command), self.timeout))
+            self._timed_out.set()
+
+        # Children left by an ended shell may still hold the pipes open
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            # Ended in the meantime
+            pass
+
+    def poll(self):
+        """Return True if the command is done"""
+        return self.process.poll() is not None
+
+    def wait(self):
+        """Wait for the command to end and return its ProcessResult
+
+        If stdout was given to a parser which raised, the exception is
+        raised here, unless the command itself failed.
+        """
+        if self._result is not None:
+            return self._result
+
+        returncode = self.process.wait()
+        for thread in self._threads:
+            thread.join()
+        if self._timer is not None:
+            self._timer.cancel()
+
+        if self._parse_error is not None and returncode == 0:
+            error_type, error, traceback = self._parse_error
+            raise error_type, error, traceback
+
+        self._result = ProcessResult(
+            command=self.command,
+            returncode=returncode,
+            stdout=None if self.parse is not None else "".join(self._stdout),
+            stderr="".join(self._stderr),
+            duration=time.time() - self.start_time,
+            timed_out=self._timed_out.is_set(),
+            output=self._output)
+
+        logger.debug("%s ended with exit status %d in %.2f seconds" %
+                     (_format_command(self.command), returncode,
+                      self._result.duration))
+
+        command_name = _command_name(self.command)
+        metrics.observe("process_seconds", self._result.duration,
+                        command=command_name)
+        if self._result.timed_out:
+            metrics.increment("process_timeouts_total", command=command_name)
+        elif returncode != 0:
+            metrics.increment("process_failures_total", command=command_name)
+
+        return self._result
+
+
+def run_process(command, timeout=None, parse=None):
+    """Run a command until it ends or times out, see Process"""
+    return Process(command, timeout=timeout, parse=parse).wait()
+
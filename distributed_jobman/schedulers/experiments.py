@@ -3,6 +3,9 @@ from distributed_jobman.database import database
 
 REQUIRED_CLUSTER_OPTIONS = ["root", "max_running", "max_queued"]
 DEFAULT_CLUSTER_VALUES = dict(duree="null", mem="null", env="null")
+# pack: number of workers sharing one allocation, pack_mem: memory cap of
+# each packed worker in MB, 0 for none
+OPTIONAL_CLUSTER_VALUES = dict(pack=1, pack_mem=0)
 
 
 def _validate_clusters_for_saving(clusters, experiment):
@@ -22,8 +25,12 @@ def _validate_clusters_for_saving(clusters, experiment):
                              (name, str(missing_keys)))
 
         valid_clusters[name] = DEFAULT_CLUSTER_VALUES.copy()
+        valid_clusters[name].update(OPTIONAL_CLUSTER_VALUES)
         valid_clusters[name].update(cluster)
 
+        if valid_clusters[name]["pack"] < 1:
+            raise ValueError("pack must be at least 1 for cluster %s" % name)
+
     return valid_clusters
 
 
@@ -31,7 +38,8 @@ def _validate_clusters_for_loading(clusters, experiment):
     valid_clusters = dict()
     for name, cluster in clusters.iteritems():
 
-        valid_clusters[name] = cluster.copy()
+        valid_clusters[name] = OPTIONAL_CLUSTER_VALUES.copy()
+        valid_clusters[name].update(cluster)
 
         for key, value in cluster.iteritems():
             if value == "null":
@@ -49,10 +57,11 @@ def _filter_cluster(cluster, experiments):
     return filter(lambda exp: cluster in exp["clusters"], experiments)
 
 
-def load_experiments(cluster=None, filter_eq_dct=None):
+def load_experiments(cluster=None, filter_eq_dct=None, cache=True):
 
     experiments = _filter_cluster(
-        cluster, database.load("experiments", filter_eq_dct=filter_eq_dct))
+        cluster, database.load("experiments", filter_eq_dct=filter_eq_dct,
+                               cache=cache))
 
     valid_experiments = []
     for experiment in experiments:
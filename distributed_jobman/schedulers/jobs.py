@@ -1,14 +1,34 @@
-import subprocess
+from collections import defaultdict
+import heapq
+import logging
 import sys
+import threading
+import time
 
 from jobman import sql
 
-from distributed_jobman import get_db_string
+from distributed_jobman import config, get_db_string
 from distributed_jobman.database import database
+from distributed_jobman.process import Process, run_process
+
+logger = logging.getLogger("jobs")
 
 
 JOBMAN_COMMAND_TEMPLATE = "jobman sql %(arguments)s %(db_string)s %(root)s"
 JOBDISPATCH_COMMAND_TEMPLATE = "jobdispatch %(arguments)s %(jobman)s"
+WORKER_COMMAND_TEMPLATE = ("distributed-jobman worker --root=%(root)s "
+                           "%(arguments)s%(name)s")
+
+HEARTBEAT = "jobman.heartbeat"
+
+# Seconds of changes fetched again by each poll of a JobsWatch
+WATCH_MARGIN = 60
+
+STATUSES = dict(
+    pending=[sql.START],
+    running=[sql.RUNNING],
+    completed=[sql.DONE],
+    broken=[sql.ERR_START, sql.ERR_SYNC, sql.ERR_RUN])
 
 
 def _build_jobman_command_string(db_string, root, nb_of_jobs_to_launch=None):
@@ -20,11 +40,32 @@ def _build_jobman_command_string(db_string, root, nb_of_jobs_to_launch=None):
             dict(arguments=arguments_string, db_string=db_string, root=root))
 
 
-def _build_jobdispatch_command_string(cluster, experiment, nb_of_jobs_to_launch):
-    db_string = get_db_string(experiment["table"])
-
-    jobman_command_string = _build_jobman_command_string(
-        db_string, experiment["clusters"][cluster]["root"])
+def _build_worker_command_string(experiment, root, pack=1, pack_mem=0):
+    arguments_string = ""
+    if pack > 1:
+        arguments_string += "--pack=%d " % pack
+    if pack_mem > 0:
+        arguments_string += "--pack-mem=%d " % pack_mem
+
+    return (WORKER_COMMAND_TEMPLATE %
+            dict(name=experiment["name"], root=root,
+                 arguments=arguments_string))
+
+
+def _build_jobdispatch_command_string(cluster, experiment, nb_of_jobs_to_launch,
+                                      workers=False):
+    cluster_config = experiment["clusters"][cluster]
+    pack = cluster_config.get("pack", 1)
+
+    # Packed allocations run workers, one-shot jobman jobs cannot share them
+    if workers or pack > 1:
+        jobman_command_string = _build_worker_command_string(
+            experiment, cluster_config["root"], pack,
+            cluster_config.get("pack_mem", 0))
+    else:
+        db_string = get_db_string(experiment["table"])
+        jobman_command_string = _build_jobman_command_string(
+            db_string, cluster_config["root"])
 
     arguments_string = ""
     if experiment.get("gpu", False):
@@ -44,22 +85,11 @@ def _build_jobdispatch_command_string(cluster, experiment, nb_of_jobs_to_launch)
     return command_string
 
 
-def _run_process(command_string):
-
-    command_string
-    process = subprocess.Popen([command_string],
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE,
-                               shell=True)
-
-    if process.returncode is not None and process.returncode < 0:
-        sys.stderr.write(process.stderr.read())
-        return -1
+def _print_result(result):
+    sys.stdout.write(result.stdout + "\n")
+    sys.stdout.write(result.stderr + "\n")
 
-    sys.stdout.write(process.stdout.read() + "\n")
-    sys.stdout.write(process.stderr.read() + "\n")
-
-    return 1
+    return result
 
 
 def is_pending(job):
@@ -78,51 +108,262 @@ def is_broken(job):
     return (job["jobman"]["status"] in [sql.ERR_RUN, sql.ERR_SYNC, sql.ERR_START])
 
 
-def load_pending_jobs(table_name):
+def load_pending_jobs(table_name, fields=None):
+
+    jobs = load_jobs(table_name, {sql.STATUS: STATUSES["pending"]},
+                     fields=fields)
+
+    return jobs
+
+
+def load_running_jobs(table_name, fields=None):
 
-    jobs = load_jobs(table_name, {"jobman.status": sql.START})
+    jobs = load_jobs(table_name, {sql.STATUS: STATUSES["running"]},
+                     fields=fields)
 
     return jobs
 
 
-def load_running_jobs(table_name):
+def load_completed_jobs(table_name, fields=None):
 
-    jobs = load_jobs(table_name, {"jobman.status": sql.RUNNING})
+    jobs = load_jobs(table_name, {sql.STATUS: STATUSES["completed"]},
+                     fields=fields)
 
     return jobs
 
 
-def load_completed_jobs(table_name):
+def load_broken_jobs(table_name, fields=None):
 
-    jobs = load_jobs(table_name, {"jobman.status": sql.DONE})
+    jobs = load_jobs(table_name, {sql.STATUS: STATUSES["broken"]},
+                     fields=fields)
 
     return jobs
 
 
-def load_broken_jobs(table_name):
+def count_jobs(table_name, sample_size=0):
+    """Count jobs of each status group (pending, running, completed, broken)
+
+    Returns a dict mapping each group in STATUSES to a tuple (count, ids)
+    where ids holds at most `sample_size` of the smallest job ids of that
+    group. The total number of jobs, whatever their status, is given under
+    `total`. Counts are computed by the database, no job is loaded.
+    """
+    counts = database.count_by_status(table_name, sample_size=sample_size)
 
-    jobs = load_jobs(table_name)
+    jobs_count = dict(total=(sum(count for count, ids in counts.itervalues()),
+                             []))
+    for name, statuses in STATUSES.iteritems():
+        count = 0
+        ids = []
+        for status in statuses:
+            status_count, status_ids = counts.get(status, (0, []))
+            count += status_count
+            ids += status_ids
+        jobs_count[name] = (count, sorted(ids)[:sample_size])
 
-    return [job for job in jobs if is_broken(job)]
+    return jobs_count
 
 
 def job_exists(table_name, job):
 
     if "id" in job:
-        jobs = database.load(table_name, job["id"])
+        jobs = database.load(table_name, row_id=job["id"],
+                             fields=[sql.JOBID])
     else:
-        jobs = database.load(table_name, hash_of=job)
+        jobs = database.load(table_name, hash_of=job, fields=[sql.JOBID])
 
     return len(jobs) == 1
 
 
-def load_jobs(table_name, filter_eq_dct=None, job_id=None, hash_of=None):
+def load_jobs(table_name, filter_eq_dct=None, job_id=None, hash_of=None,
+              fields=None, cache=True):
 
-    jobs = database.load(table_name, filter_eq_dct, job_id, hash_of=hash_of)
+    jobs = database.load(table_name, filter_eq_dct, job_id, hash_of=hash_of,
+                         fields=fields, cache=cache)
 
     return jobs
 
 
+def iter_jobs(table_name, filter_eq_dct=None, order_by="id", limit=None,
+              page_size=1000, fields=None):
+    """Iterate over jobs one page at a time, see Database.iterate"""
+    return database.iterate(table_name, filter_eq_dct, order_by=order_by,
+                            limit=limit, page_size=page_size, fields=fields)
+
+
+def load_job_ids(table_name, filter_eq_dct=None, order_by="id", limit=None):
+    """Load ids of jobs, ordered and limited in the database"""
+    ids = []
+    for page in database.iterate_ids(table_name, filter_eq_dct,
+                                     order_by=order_by, limit=limit):
+        ids += page
+
+    return ids
+
+
+def claim_jobs(table_name, nb_of_jobs=1, filter_eq_dct=None, hash_of=None):
+    """Atomically move up to nb_of_jobs pending jobs to running, return them
+
+    Concurrent callers never get the same job, see Database.claim. The
+    heartbeat of claimed jobs is set to the current time.
+    """
+    return database.claim(table_name, nb_of_jobs, filter_eq_dct=filter_eq_dct,
+                          hash_of=hash_of,
+                          update_dict={HEARTBEAT: time.time()})
+
+
+def reap_jobs(table_name, timeout=None):
+    """Set running jobs whose heartbeat is older than timeout back to pending
+
+    timeout defaults to stale_timeout of the worker section of
+    ~/.distributed_jobman.rc, it should span several heartbeat intervals.
+    Jobs which never wrote a heartbeat are left untouched. Returns the ids
+    of stale jobs reset, those completed in the meantime are left as is.
+    """
+    if timeout is None:
+        timeout = config["worker"]["stale_timeout"]
+
+    running = {sql.STATUS: STATUSES["running"]}
+    ids = database.stale_ids(table_name, HEARTBEAT, time.time() - timeout,
+                             filter_eq_dct=running)
+
+    if len(ids) == 0:
+        return []
+
+    # Jobs completed since the lookup are filtered out
+    reset_ids, failed_ids = update_jobs(
+        table_name, [dict(id=job_id) for job_id in ids],
+        {sql.STATUS: sql.START, 'proc_status': "pending"},
+        filter_eq_dct=running, return_ids=True)
+
+    return reset_ids
+
+
+class Heartbeat(object):
+    """Periodically write the current time in the heartbeat of running jobs
+
+    Jobs are registered with add() and unregistered with remove(). A
+    background thread updates all registered jobs every `interval` seconds,
+    with one statement per table. interval defaults to heartbeat_interval of
+    the worker section of ~/.distributed_jobman.rc.
+    """
+
+    def __init__(self, interval=None):
+        if interval is None:
+            interval = config["worker"]["heartbeat_interval"]
+        self.interval = interval
+        self._ids = defaultdict(set)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    def add(self, table_name, job_id):
+        with self._lock:
+            self._ids[table_name].add(job_id)
+
+    def remove(self, table_name, job_id):
+        with self._lock:
+            self._ids[table_name].discard(job_id)
+
+    def beat(self):
+        with self._lock:
+            ids = dict((table_name, sorted(job_ids))
+                       for table_name, job_ids in self._ids.iteritems()
+                       if len(job_ids) > 0)
+
+        for table_name, job_ids in ids.iteritems():
+            try:
+                database.touch(table_name, job_ids, HEARTBEAT, time.time())
+            except Exception:
+                logger.exception("Heartbeat failed for jobs %s of table %s" %
+                                 (str(job_ids), table_name))
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.beat()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exception_type, exception_val, traceback):
+        self.stop()
+
+
+class JobsWatch(object):
+    """Status of the jobs of a table, kept up to date from its changes
+
+    The first poll() loads the status of all jobs, following ones only
+    fetch jobs updated since, see Database.status_changes, so that their
+    cost depends on the number of changes and not on the size of the table.
+    Changes stamped up to `margin` seconds before the last one seen are
+    fetched again, as commits are not ordered by their time stamps.
+    """
+
+    def __init__(self, table_name, margin=WATCH_MARGIN):
+        self.table_name = table_name
+        self.margin = margin
+        self.statuses = dict()
+        self.updated_at = dict()
+        self.last_update = None
+
+    def poll(self):
+        """Apply changes since the last poll, return the number of jobs
+        updated, whether their status changed or not"""
+        if self.last_update is None:
+            since = None
+        else:
+            since = self.last_update - self.margin
+
+        nb_of_updates = 0
+        for job_id, status, updated_at in database.status_changes(
+                self.table_name, since):
+            if status is None:
+                if self.statuses.pop(job_id, None) is not None:
+                    del self.updated_at[job_id]
+                    nb_of_updates += 1
+            elif self.updated_at.get(job_id, None) != updated_at:
+                self.statuses[job_id] = status
+                self.updated_at[job_id] = updated_at
+                nb_of_updates += 1
+
+            if self.last_update is None or updated_at > self.last_update:
+                self.last_update = updated_at
+
+        return nb_of_updates
+
+    def count(self, sample_size=0):
+        """Count jobs as count_jobs() does, from the statuses in memory"""
+        ids = defaultdict(list)
+        for job_id, status in self.statuses.iteritems():
+            ids[status].append(job_id)
+
+        jobs_count = dict(total=(len(self.statuses), []))
+        for name, statuses in STATUSES.iteritems():
+            group_ids = sum((ids[status] for status in statuses), [])
+            jobs_count[name] = (len(group_ids),
+                                heapq.nsmallest(sample_size, group_ids))
+
+        return jobs_count
+
+
 def save_job(table_name, job_desc):
 
     job = database.save(table_name, job_desc)
@@ -130,22 +371,71 @@ def save_job(table_name, job_desc):
     return job
 
 
-def update_jobs(table_name, jobs, update_dict):
-    return database.update(table_name, jobs, update_dict)
+def save_jobs(table_name, job_descs):
+    """Register many new jobs at once, returns their ids
+
+    job_descs can be any iterable, e.g. a generator over a hyper-parameter
+    grid, it is never held in memory as a whole.
+    """
+    return database.save_many(table_name, job_descs)
+
+
+def update_jobs(table_name, jobs, update_dict, filter_eq_dct=None,
+                progress=None, return_ids=False):
+    return database.update(table_name, jobs, update_dict,
+                           filter_eq_dct=filter_eq_dct, progress=progress,
+                           return_ids=return_ids)
+
+
+def set_jobs(table_name, status, update_dict, progress=None):
+    """Apply update_dict to all jobs of given status group (see STATUSES)"""
+    return update_jobs(table_name, None, update_dict,
+                       filter_eq_dct={sql.STATUS: STATUSES[status]},
+                       progress=progress)
+
+
+def delete_jobs(table_name, jobs, filter_eq_dct=None, progress=None):
+    return database.delete(table_name, jobs, filter_eq_dct=filter_eq_dct,
+                           progress=progress)
+
+
+def delete_all_jobs(table_name, progress=None):
+    return database.delete(table_name, None, progress=progress)
+
+
+def rebuild_status(table_name):
+    return database.rebuild_status(table_name)
+
 
+def submit_job(cluster, experiment, nb_of_jobs_to_launch, workers=False):
+    """Submit jobs with jobdispatch, return its ProcessResult
 
-def delete_jobs(table_name, jobs):
-    return database.delete(table_name, jobs)
+    If workers is True, nb_of_jobs_to_launch workers are submitted, each
+    one running pending jobs of the experiment until none is left. If the
+    experiment packs jobs on this cluster (see pack in its clusters
+    configuration), each of the nb_of_jobs_to_launch allocations runs pack
+    workers. Raises process.ProcessError if jobdispatch fails or times out.
+    """
+    return _print_result(start_job_submission(
+        cluster, experiment, nb_of_jobs_to_launch, workers).wait().check())
 
 
-def submit_job(cluster, experiment, nb_of_jobs_to_launch):
+def start_job_submission(cluster, experiment, nb_of_jobs_to_launch,
+                         workers=False):
+    """Start jobdispatch in the background, return its process.Process
 
-    return _run_process(_build_jobdispatch_command_string(
-        cluster, experiment, nb_of_jobs_to_launch))
+    jobdispatch is killed after submit_timeout seconds, set in the launch
+    section of ~/.distributed_jobman.rc.
+    """
+    return Process(
+        _build_jobdispatch_command_string(
+            cluster, experiment, nb_of_jobs_to_launch, workers),
+        timeout=config["launch"]["submit_timeout"])
 
 
 def submit_local_job(experiment, nb_of_jobs_to_launch, root):
     db_string = get_db_string(experiment["table"])
 
-    return _run_process(_build_jobman_command_string(
-        db_string, root, nb_of_jobs_to_launch))
+    return _print_result(run_process(
+        _build_jobman_command_string(db_string, root, nb_of_jobs_to_launch))
+        .check())
@@ -1,3 +1,5 @@
+from collections import defaultdict, OrderedDict
+import cPickle
 import json
 import logging
 import os
@@ -6,9 +8,9 @@ import sys
 import threading
 import time
 
-from jobman.api0 import DbHandle
 from sqlalchemy.exc import TimeoutError
-from sqlalchemy.orm.session import Session
+
+from distributed_jobman import metrics
 
 
 logger = logging.getLogger("utils")
@@ -56,60 +58,134 @@ def query_yes_no(question):
                              "(or 'y' or 'n').\n")
 
 
-def hash_dicts(iterable):
-    hashed = []
-    for item in iterable:
-        if isinstance(item, dict):
-            items = item.items()
-            items.sort()
-            hashed.append(hash_dicts(items))
-        elif isinstance(item, (list, tuple)):
-            hashed.append(hash_dicts(item))
-        elif isinstance(item, DbHandle):
-            hashed.append(item.tablename)
-        elif isinstance(item, Session):
-            hashed.append(None)
-        else:
-            hashed.append(item)
-
-    return tuple(hashed)
-
-
 class Cache(object):
-    _caches = {}
-    _timeouts = {}
+    """Read-through cache with least-recently-used and time-to-live eviction
+
+    Entries belong to a namespace, e.g. a table name, so that all entries of
+    a namespace can be invalidated at once. Values are stored pickled, the
+    total size in bytes of pickled entries never exceeds `max_bytes`. A
+    fresh copy is unpickled on each hit, callers are free to modify it.
+    """
 
-    def __init__(self, timeout=2):
+    def __init__(self, timeout=2, max_bytes=64 * 1024 * 1024):
         self.timeout = timeout
+        self.max_bytes = max_bytes
+
+        # (namespace, key) -> pickled value, least recently used first
+        self._entries = OrderedDict()
+        # (namespace, key) -> time of insertion, oldest first
+        self._insertion_times = OrderedDict()
+        # Bumped on invalidation to drop values computed meanwhile
+        self._generations = defaultdict(int)
+        self._lock = threading.Lock()
+
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, namespace, key, compute):
+        """Return cached value for key, or compute() and cache it"""
+
+        entry_key = (namespace, key)
+        with self._lock:
+            self.collect()
+            entry = self._entries.pop(entry_key, None)
+            if entry is not None:
+                self._entries[entry_key] = entry
+                self.hits += 1
+                return cPickle.loads(entry)
+            self.misses += 1
+            generation = self._generations[namespace]
+
+        value = compute()
+
+        pickled_value = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            if (len(pickled_value) <= self.max_bytes and
+                    generation == self._generations[namespace]):
+                self._remove(entry_key)
+                self._entries[entry_key] = pickled_value
+                self._insertion_times[entry_key] = time.time()
+                self.size += len(pickled_value)
+                while self.size > self.max_bytes:
+                    self._remove(next(iter(self._entries)))
+                    self.evictions += 1
+
+        return value
+
+    def invalidate(self, namespace=None):
+        """Remove all entries of namespace, or all entries if None"""
+
+        with self._lock:
+            for entry_key in list(self._entries):
+                if namespace is None or entry_key[0] == namespace:
+                    self._remove(entry_key)
+            if namespace is None:
+                for generated_namespace in self._generations:
+                    self._generations[generated_namespace] += 1
+            else:
+                self._generations[namespace] += 1
 
     def collect(self):
         """Clear cache of results which have timed out"""
-        for func in self._caches:
-            cache = {}
-            for key in self._caches[func]:
-                if (time.time() - self._caches[func][key][1]) < self._timeouts[func]:
-                    cache[key] = self._caches[func][key]
-            self._caches[func] = cache
-
-    def __call__(self, f):
-        self.cache = self._caches[f.func_name] = {}
-        self._timeouts[f.func_name] = self.timeout
-
-        def func(*args, **kwargs):
-            kw = kwargs.items()
-            kw.sort()
-            key = (hash_dicts(args), hash_dicts(tuple(kw)))
-            try:
-                v = self.cache[key]
-                if (time.time() - v[1]) > self.timeout:
-                    raise KeyError
-            except KeyError:
-                v = self.cache[key] = f(*args, **kwargs), time.time()
-            return v[0]
-
-        func.func_name = f.func_name
-
-        return func
+        expiration_time = time.time() - self.timeout
+        while len(self._insertion_times) > 0:
+            entry_key, insertion_time = next(
+                self._insertion_times.iteritems())
+            if insertion_time >= expiration_time:
+                break
+            self._remove(entry_key)
+            self.evictions += 1
+
+    def _remove(self, entry_key):
+        entry = self._entries.pop(entry_key, None)
+        self._insertion_times.pop(entry_key, None)
+        if entry is not None:
+            self.size -= len(entry)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, entries=len(self._entries),
+                    bytes=self.size)
+
+
+class TokenBucket(object):
+    """Rate limiter allowing `rate` operations per second in average
+
+    Up to `capacity` operations can be done in a burst after a pause. A
+    rate of 0 or less disables the limitation.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._last_time = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` operations are allowed"""
+        if self.rate <= 0:
+            return
+
+        if tokens > self.capacity:
+            raise ValueError("Cannot acquire %s tokens from a bucket of "
+                             "capacity %s" % (tokens, self.capacity))
+
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(
+                    self.capacity,
+                    self._tokens + (now - self._last_time) * self.rate)
+                self._last_time = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                waiting_time = (tokens - self._tokens) / self.rate
+
+            time.sleep(waiting_time)
 
 
 class Timer(object):
@@ -127,14 +203,22 @@ class Timer(object):
     def __enter__(self):
         logger.debug("Set timer for %d seconds..." % self.seconds)
 
-        self.t = threading.Timer(self.seconds, self.custom_timer_handler)
+        self.t = threading.Timer(self.seconds, self.timeout)
         self.t.start()
 
+    def timeout(self):
+        metrics.increment("timer_timeouts_total")
+        self.custom_timer_handler()
+
     def __exit__(self, exception_type, exception_val, traceback):
         logger.debug("Timer canceled")
         self.t.cancel()
 
 
+class SessionInterrupted(Exception):
+    """Raised in the body of a SafeSession rolled back by a signal"""
+
+
 class SafeSession(object):
 
     def __init__(self, db):
@@ -151,28 +235,62 @@ class SafeSession(object):
         self.restore_signal_handlers()
         self.rollback()
 
+        if signal_number is None or not self.handles_signals:
+            return
+
+        # Let handlers installed before the session know about the signal
+        previous_handler = {
+            signal.SIGINT: self.previous_sigint_handler,
+            signal.SIGTERM: self.previous_sigterm_handler}.get(signal_number)
+        if callable(previous_handler):
+            previous_handler(signal_number, frame)
+
+        # The transaction is rolled back, the rest of the session body must
+        # not run in a new one
+        raise SessionInterrupted("transaction interrupted by signal %d" %
+                                 signal_number)
+
+    def commit(self):
+        with metrics.time_block("session_commit_seconds",
+                                table=self.db.table_name):
+            self.session.commit()
+
     def rollback(self):
         logger.warning("An error occured during transaction, session is "
                        "rolled back.")
+        metrics.increment("session_rollbacks_total",
+                          table=self.db.table_name)
         self.session.rollback()
         self.session.close()
 
     def restore_signal_handlers(self):
+        if not self.handles_signals:
+            return
+
         signal.signal(signal.SIGINT, self.previous_sigint_handler)
         signal.signal(signal.SIGTERM, self.previous_sigterm_handler)
 
     def __enter__(self):
         logger.debug("open safe session")
+        self.start_time = time.time()
         self.session = self.db.session()
-        self.previous_sigint_handler = signal.signal(
-            signal.SIGINT, self.handle_interrupt)
-        self.previous_sigterm_handler = signal.signal(
-            signal.SIGTERM, self.handle_interrupt)
+        # Signal handlers can only be installed from the main thread, sessions
+        # of other threads are only rolled back on errors
+        self.handles_signals = isinstance(threading.current_thread(),
+                                          threading._MainThread)
+        if self.handles_signals:
+            self.previous_sigint_handler = signal.signal(
+                signal.SIGINT, self.handle_interrupt)
+            self.previous_sigterm_handler = signal.signal(
+                signal.SIGTERM, self.handle_interrupt)
         return self
 
     def __exit__(self, exception_type, exception_val, traceback):
+        metrics.observe("session_seconds", time.time() - self.start_time,
+                        table=self.db.table_name)
         if exception_type is not None:
-            self.handle_interrupt(None, None)
+            if not issubclass(exception_type, SessionInterrupted):
+                self.handle_interrupt(None, None)
             raise
         else:
             self.restore_signal_handlers()